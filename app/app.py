@@ -1,18 +1,39 @@
+import asyncio
+from concurrent.futures import Executor
+from functools import partial
+
 from fastapi import Depends, FastAPI, Request
 from fastapi.responses import HTMLResponse, RedirectResponse
 from jose import JWTError
 from pydantic import ValidationError
 
-from .chat_api import make_api as make_chat_api
-from .email_auth_api import make_api as make_email_auth_api, get_user_token, User, UserToken
-from .pages import chat_container, chat_and_connect_scripts, email_login_page, main_page
-
-
-async def send_login_email(*, user: User, token: str, request_url: str) -> None:
-    print(f"LOGIN AT: {request_url}email-authorize/{token}")
+from .auth_middleware import WebSocketAuthMiddleware
+from .chat_api import make_api as make_chat_api, make_connection_manager_registry
+from .connection_manager import ConnectionManagerRegistry
+from .email_auth_api import make_api as make_email_auth_api, get_user_token, LoginEmailSender, UserToken
+from .email_dispatch import LoginEmailDispatcher, LoginEmailTransport, print_login_emails, SMTPConnectionPool
+from .message_index import MessageIndex
+from .message_pipeline import (
+    extract_mentions,
+    Inline,
+    make_word_filter,
+    mask_links,
+    MessagePipeline,
+    normalize_length,
+    Offloaded,
+    PipelineStage,
+    RestartingProcessPool,
+)
+from .revocation import get_revocation_store
+from .room_directory import RoomDirectory
+from .settings import get_settings
+from .snapshot import StateSnapshotter
+from .tracing import MessageTracer, TraceFileExporter
 
 
 def token_auth_error_handler(_exception: JWTError | ValidationError, /) -> HTMLResponse:
+    from .pages import email_login_page
+
     return HTMLResponse(
         str(
             email_login_page(
@@ -24,8 +45,9 @@ def token_auth_error_handler(_exception: JWTError | ValidationError, /) -> HTMLR
     )
 
 
-def register_routes(*, app: FastAPI):
-    # -- Register routers and path in order of priority
+def register_page_routes(*, app: FastAPI):
+    # The UI package is only imported if the pages are served.
+    from .pages import chat_container, chat_and_connect_scripts, email_login_page, main_page
 
     @app.get("/")
     async def home(user_token: UserToken | None = Depends(get_user_token)):
@@ -65,21 +87,197 @@ def register_routes(*, app: FastAPI):
             )
         )
 
+
+def register_routes(
+    *,
+    app: FastAPI,
+    connection_manager_registry: ConnectionManagerRegistry,
+    send_login_email: LoginEmailSender,
+    room_directory: RoomDirectory | None = None,
+    message_index: MessageIndex | None = None,
+    message_pipeline: MessagePipeline | None = None,
+    message_tracer: MessageTracer | None = None,
+    max_message_size: int = 64 * 1024,
+    headless: bool = False,
+):
+    # -- Register routers and path in order of priority
+
+    if not headless:
+        register_page_routes(app=app)
+
     app.include_router(
         make_email_auth_api(
             app_redirect_url="/",
-            send_login_email=send_login_email,  # type: ignore[arg-type]
-            token_auth_error_handler=token_auth_error_handler,
+            send_login_email=send_login_email,
+            token_auth_error_handler=None if headless else token_auth_error_handler,
         )
     )
-    app.include_router(make_chat_api(), prefix="/chat")
+    app.include_router(
+        make_chat_api(
+            connection_manager_registry=connection_manager_registry,
+            room_directory=room_directory,
+            message_index=message_index,
+            message_pipeline=message_pipeline,
+            message_tracer=message_tracer,
+            max_message_size=max_message_size,
+        ),
+        prefix="/chat",
+    )
 
     return  # Skip the rest.
 
 
-def create_app():
+def make_login_email_transport() -> LoginEmailTransport:
+    settings = get_settings()
+    if settings.smtp_host is None:
+        return print_login_emails
+
+    return SMTPConnectionPool(
+        hostname=settings.smtp_host,
+        port=settings.smtp_port,
+        sender=settings.smtp_sender,
+        username=settings.smtp_username,
+        password=settings.smtp_password,
+        start_tls=settings.smtp_start_tls,
+        size=settings.smtp_pool_size,
+    )
+
+
+def make_message_pipeline(*, executor: Executor | None = None) -> MessagePipeline:
+    settings = get_settings()
+    # Only the regex-heavy filters are worth the round trip to the worker pool.
+    stages: list[PipelineStage] = [Inline(partial(normalize_length, max_length=settings.message_max_length))]
+    if settings.message_blocked_words:
+        stages.append(Offloaded(make_word_filter(settings.message_blocked_words)))
+    if settings.message_mask_links:
+        stages.append(Offloaded(mask_links))
+    stages.append(Inline(extract_mentions))
+
+    return MessagePipeline(stages, executor=executor)
+
+
+def create_app(
+    *,
+    headless: bool | None = None,
+    snapshot_file: str | None = None,
+    trace_file: str | None = None,
+    max_message_size: int = 64 * 1024,
+):
+    """
+    Creates the application.
+
+    Arguments:
+        headless: Whether to serve only the APIs without the HTML pages. Defaults to the `headless` setting.
+        snapshot_file: The file the chat state is restored from on startup and saved to periodically and on
+            shutdown. Defaults to the `snapshot_file` setting, the state is not persisted if neither is set.
+        trace_file: The file sampled message traces are written to. Defaults to the `trace_file` setting.
+            Messages are only traced if the `trace_sample_rate` setting is positive.
+        max_message_size: The maximum size of chat messages sent with HTTP requests in bytes, it should match
+            the maximum websocket message size of the server.
+    """
     app = FastAPI()
 
-    register_routes(app=app)
+    settings = get_settings()
+    if headless is None:
+        headless = settings.headless
+    if settings.websocket_auth_middleware:
+        app.add_middleware(WebSocketAuthMiddleware, jwt_key=settings.jwt_key, revocation_store=get_revocation_store())
+
+    login_email_transport = make_login_email_transport()
+    login_email_dispatcher = LoginEmailDispatcher(
+        transport=login_email_transport, worker_count=settings.smtp_pool_size
+    )
+
+    @app.on_event("startup")
+    async def start_login_email_dispatcher():
+        await login_email_dispatcher.start()
+
+    @app.on_event("startup")
+    async def start_revocation_store():
+        # Load the revoked tokens before serving requests, then keep them in sync in the background.
+        await get_revocation_store().start()
+
+    @app.on_event("shutdown")
+    async def stop_revocation_store():
+        await get_revocation_store().stop()
+
+    @app.on_event("shutdown")
+    async def stop_login_email_dispatcher():
+        await login_email_dispatcher.stop()
+        if isinstance(login_email_transport, SMTPConnectionPool):
+            await login_email_transport.close()
+
+    message_filter_executor: RestartingProcessPool | None = None
+    if settings.message_filter_processes > 0:
+        message_filter_executor = RestartingProcessPool(settings.message_filter_processes)
+
+        @app.on_event("shutdown")
+        def stop_message_filter_executor():
+            message_filter_executor.shutdown(cancel_futures=True)
+
+    # Stored on the app state, so the server can close the chat rooms when it shuts down.
+    app.state.connection_manager_registry = make_connection_manager_registry()
+
+    room_directory = RoomDirectory()
+    message_index = MessageIndex()
+
+    # Stored on the app state, so the server can take the last snapshot before it closes the chat rooms.
+    app.state.snapshotter = None
+    if snapshot_file is None:
+        snapshot_file = settings.snapshot_file
+    if snapshot_file is not None:
+        snapshotter = app.state.snapshotter = StateSnapshotter(
+            snapshot_file,
+            message_index=message_index,
+            room_directory=room_directory,
+            interval=settings.snapshot_interval,
+        )
+
+        @app.on_event("startup")
+        async def restore_snapshot():
+            # Startup handlers run before the server accepts connections.
+            if snapshotter.restore():
+                # Reset the occupancy of the rooms whose clients didn't come back.
+                registry: ConnectionManagerRegistry = app.state.connection_manager_registry
+                asyncio.get_running_loop().call_later(
+                    settings.snapshot_reconnect_grace,
+                    snapshotter.reconcile,
+                    lambda room: len(cm) if (cm := registry.get_connection_manager(room)) is not None else 0,
+                )
+
+            await snapshotter.start()
+
+        @app.on_event("shutdown")
+        async def save_snapshot():
+            await snapshotter.stop()
+
+    message_tracer: MessageTracer | None = None
+    if settings.trace_sample_rate > 0:
+        trace_exporter = TraceFileExporter(
+            settings.trace_file if trace_file is None else trace_file,
+            max_bytes=settings.trace_file_max_bytes,
+            backup_count=settings.trace_file_backup_count,
+        )
+        message_tracer = MessageTracer(trace_exporter, sample_rate=settings.trace_sample_rate)
+
+        @app.on_event("startup")
+        def start_trace_exporter():
+            trace_exporter.start()
+
+        @app.on_event("shutdown")
+        def stop_trace_exporter():
+            trace_exporter.stop()
+
+    register_routes(
+        app=app,
+        connection_manager_registry=app.state.connection_manager_registry,
+        send_login_email=login_email_dispatcher,
+        room_directory=room_directory,
+        message_index=message_index,
+        message_pipeline=make_message_pipeline(executor=message_filter_executor),
+        message_tracer=message_tracer,
+        max_message_size=max_message_size,
+        headless=headless,
+    )
 
     return app
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+from functools import lru_cache
+import time
+
+from jose import jwt, JWTError
+from jose.constants import ALGORITHMS
+from pydantic import ValidationError
+from starlette.requests import cookie_parser
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .chat_api import CHAT_USER_SCOPE_KEY, ChatUser
+from .email_auth_api import USER_TOKEN_COOKIE, UserToken
+from .revocation import RevocationStore
+
+
+class WebSocketAuthMiddleware:
+    """
+    ASGI middleware that authenticates websocket handshakes before routing.
+
+    The user token cookie is verified once per connection with a preloaded key and the result is
+    cached by token, so reconnecting clients skip both the JWT verification and the dependency chain
+    of `get_user_token()`. Expiry and revocation are still checked on every handshake.
+
+    The `ChatUser` record of the verified user is stored in the scope under `CHAT_USER_SCOPE_KEY` (see
+    `requires_websocket_chat_user()`), and handshakes without a valid token are rejected.
+
+    Other connection types are passed through untouched.
+    """
+
+    __slots__ = (
+        "_app",
+        "_revocation_store",
+        "_verify",
+    )
+
+    def __init__(
+        self, app: ASGIApp, *, jwt_key: str, revocation_store: RevocationStore, cache_size: int = 4096
+    ) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            app: The wrapped ASGI application.
+            jwt_key: The key user tokens are signed with.
+            revocation_store: The store of revoked user tokens.
+            cache_size: The maximum number of verified tokens to cache.
+        """
+        self._app = app
+        self._revocation_store = revocation_store
+
+        @lru_cache(maxsize=cache_size)
+        def verify(token: str) -> UserToken | None:
+            try:
+                return UserToken(**jwt.decode(token, key=jwt_key, algorithms=[ALGORITHMS.HS256]))
+            except (JWTError, ValidationError):
+                return None
+
+        self._verify = verify
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "websocket":
+            await self._app(scope, receive, send)
+            return
+
+        token = self._get_token_cookie(scope)
+        user_token = None if token is None else self._verify(token)
+        if user_token is None or user_token.exp <= time.time() or self._revocation_store.is_revoked(user_token.jti):
+            # Closing the connection before accepting it rejects the handshake with HTTP 403.
+            await send({"type": "websocket.close", "code": 1008})
+            return
+
+        scope[CHAT_USER_SCOPE_KEY] = ChatUser.intern(user_token)
+        await self._app(scope, receive, send)
+
+    @staticmethod
+    def _get_token_cookie(scope: Scope) -> str | None:
+        """
+        Returns the user token cookie from the headers of the given scope.
+        """
+        for name, value in scope["headers"]:
+            if name == b"cookie":
+                return cookie_parser(value.decode("latin-1")).get(USER_TOKEN_COOKIE, None)
+
+        return None
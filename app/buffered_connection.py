@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from secrets import token_urlsafe
+
+from .connection_manager import Message, UserId
+
+
+class BufferedConnection:
+    """
+    Connection for transports that can not push messages to the client the moment they are sent,
+    like server-sent events and long polling.
+
+    Sent messages are numbered and kept in a bounded buffer. Clients read every buffered message
+    after their cursor (the number of the last message they have seen) in one go, so a client
+    that fell behind catches up in a single response. When the buffer is full, the oldest
+    messages are dropped.
+    """
+
+    __slots__ = (
+        "_buffer",
+        "_closed",
+        "_event",
+        "_last_seq",
+        "client_id",
+        "user_id",
+    )
+
+    def __init__(self, *, user_id: UserId = None, max_buffer_size: int = 256) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            user_id: The ID of the user who owns the connection.
+            max_buffer_size: The maximum number of messages the connection buffers.
+        """
+        self.client_id = token_urlsafe(16)
+        self.user_id = user_id
+        self._buffer: deque[tuple[int, Message]] = deque(maxlen=max_buffer_size)
+        self._closed = False
+        self._event = asyncio.Event()
+        self._last_seq = 0
+
+    @property
+    def is_closed(self) -> bool:
+        """
+        Whether the connection is closed.
+        """
+        return self._closed
+
+    async def accept(self) -> None:
+        """
+        Accepts the connection. There is nothing to do, the client is already connected.
+        """
+        ...
+
+    async def send_text(self, data: Message) -> None:
+        """
+        Buffers the given message and wakes up the waiting readers.
+        """
+        self._last_seq += 1
+        self._buffer.append((self._last_seq, data))
+        self._event.set()
+
+    async def close(self, code: int = 1000) -> None:
+        """
+        Closes the connection and wakes up the waiting readers.
+        """
+        self.close_nowait()
+
+    def close_nowait(self) -> None:
+        """
+        Synchronous version of `close()`.
+        """
+        self._closed = True
+        self._event.set()
+
+    def read(self, cursor: int) -> list[tuple[int, Message]]:
+        """
+        Returns every buffered message that comes after the given cursor, together with its sequence number.
+
+        Arguments:
+            cursor: The sequence number of the last message the client has seen.
+        """
+        buffer = self._buffer
+        if not buffer or buffer[-1][0] <= cursor:
+            return []
+
+        # Sequence numbers are consecutive, so the position of the cursor can be calculated.
+        start = max(cursor - buffer[0][0] + 1, 0)
+        return [buffer[i] for i in range(start, len(buffer))]
+
+    async def receive(self, cursor: int, *, timeout: float) -> list[tuple[int, Message]]:
+        """
+        Waits at most `timeout` seconds for messages after the given cursor and returns them.
+
+        Arguments:
+            cursor: The sequence number of the last message the client has seen.
+            timeout: The maximum number of seconds to wait for new messages.
+        """
+        messages = self.read(cursor)
+        if messages or self._closed:
+            return messages
+
+        self._event.clear()
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+
+        return self.read(cursor)
@@ -1,18 +1,146 @@
 from __future__ import annotations
-from typing import Protocol
+from typing import Any, AsyncIterator, Awaitable, ClassVar, NamedTuple
 
+import asyncio
 from asyncio import gather
 import json
+import sys
+from weakref import WeakValueDictionary
 
-from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
 
-from .connection_manager import ConnectionManagerRegistry, WebSocketConnectionManager
-from .email_auth_api import User, requires_user_token
+from .buffered_connection import BufferedConnection
+from .connection_manager import (
+    Connection,
+    ConnectionManager,
+    ConnectionManagerRegistry,
+    MessagePriority,
+    PrioritizedConnectionManager,
+)
+from .email_auth_api import get_websocket_user_token, User, requires_user_token, requires_websocket_user_token
+from .message_index import MessageIndex, SearchCursor
+from .message_pipeline import MessagePipeline, PipelineMessage
+from .room_directory import RoomDirectory
+from .tracing import current_trace, MessageTrace, MessageTracer
 
 RoomId = str
 
 
-def make_message(msg: str, /, *, user: User, self: bool = False) -> str:
+class RoomInfo(BaseModel):
+    """
+    Room directory entry.
+    """
+
+    room: str
+    occupancy: int
+
+
+class SearchHitInfo(BaseModel):
+    """
+    Message search hit.
+    """
+
+    seq: int
+    created_at: float
+    user: User
+    message: str
+    score: float
+
+
+class SearchResult(BaseModel):
+    """
+    Message search result page.
+    """
+
+    hits: list[SearchHitInfo]
+    cursor: str | None
+    """
+    The cursor of the next page, `None` if there are no more hits.
+    """
+
+
+class ChatUser:
+    """
+    Lightweight, immutable user record of chat connections.
+
+    Use `ChatUser.intern()` to get the record of a user: all connections of the user share the same
+    instance, which is kept alive only while the user has open connections.
+    """
+
+    __slots__ = (
+        "__weakref__",
+        "email",
+        "name",
+    )
+
+    _interned: ClassVar[WeakValueDictionary[tuple[str, str], ChatUser]] = WeakValueDictionary()
+
+    def __init__(self, *, name: str, email: str) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            name: The name of the user.
+            email: The email address of the user.
+        """
+        self.name = sys.intern(name)
+        self.email = sys.intern(email)
+
+    @classmethod
+    def intern(cls, user: User) -> ChatUser:
+        """
+        Returns the shared record of the given user.
+
+        Arguments:
+            user: The user whose record should be returned.
+        """
+        key = (user.name, user.email)
+        result = cls._interned.get(key, None)
+        if result is None:
+            result = cls(name=user.name, email=user.email)
+            cls._interned[key] = result
+
+        return result
+
+
+CHAT_USER_SCOPE_KEY = "lounge.chat_user"
+"""
+The ASGI scope key under which `WebSocketAuthMiddleware` stores the `ChatUser` record of the authenticated user.
+
+It's namespaced, because `scope["user"]` belongs to Starlette's `AuthenticationMiddleware`.
+"""
+
+
+def requires_websocket_chat_user(websocket: WebSocket) -> ChatUser:
+    """
+    Dependency that returns the shared record of the user of the current websocket connection.
+
+    If the websocket auth middleware is installed, the record it attached to the scope is returned.
+    Otherwise the user token is decoded here instead of in a sub-dependency, because FastAPI keeps
+    the results of the dependencies alive as long as the connection is open.
+
+    Raises:
+        HTTPException: If the connection doesn't have a valid user token.
+    """
+    user: ChatUser | None = websocket.scope.get(CHAT_USER_SCOPE_KEY, None)
+    if user is None:
+        user = ChatUser.intern(requires_websocket_user_token(get_websocket_user_token(websocket)))
+
+    return user
+
+
+def make_message(
+    msg: str,
+    /,
+    *,
+    user: ChatUser,
+    self: bool = False,
+    direct: bool = False,
+    room: RoomId | None = None,
+    mentions: tuple[str, ...] = (),
+) -> str:
     """
     Creates a JSON message from the given data.
 
@@ -20,57 +148,499 @@ def make_message(msg: str, /, *, user: User, self: bool = False) -> str:
         msg: Message text.
         user: The current user.
         from_self: Whether the message is sent by the current user.
+        direct: Whether the message is only sent to a subset of the users.
+        room: The room the message was sent from, set for direct messages that may reach other rooms.
+        mentions: The email addresses of the users the message mentions.
+    """
+    message: dict[str, Any] = {
+        "user": {"name": user.name, "email": user.email, "self": self},
+        "message": msg,
+        "direct": direct,
+    }
+    if room is not None:
+        message["room"] = room
+    if mentions:
+        message["mentions"] = mentions
+
+    return json.dumps(message)
+
+
+def make_typing_message(*, user: ChatUser) -> str:
+    """
+    Creates a JSON message that indicates that the given user is typing.
+
+    Arguments:
+        user: The user who is typing.
+    """
+    return json.dumps({"user": {"name": user.name, "email": user.email, "self": False}, "typing": True})
+
+
+class TargetedMessage(NamedTuple):
+    """
+    A message that should only be delivered to the listed recipients.
+    """
+
+    command: str
+    """
+    `/dm` for direct messages that reach the recipients in every room, `/to` for messages that
+    are only delivered to the recipients who are in the current room.
+    """
+
+    recipients: list[str]
+    """
+    The email addresses of the recipients, without duplicates.
+    """
+
+    message: str
+    """
+    The message text.
     """
-    return json.dumps({"user": {"name": user.name, "email": user.email, "self": self}, "message": msg})
 
 
-def make_api() -> APIRouter:
+def parse_targeted_message(data: str, /) -> TargetedMessage | None:
+    """
+    Parses `/dm <email>[,<email>...] <message>` and `/to <email>[,<email>...] <message>` messages.
+
+    Arguments:
+        data: The received message text.
+
+    Returns:
+        The parsed message or `None` if the given text is a regular chat message.
+    """
+    if not data.startswith(("/dm ", "/to ")):
+        return None
+
+    parts = data.split(maxsplit=2)
+    if len(parts) < 3:
+        return None
+
+    command, recipients, message = parts
+    return TargetedMessage(
+        command=command, recipients=list(dict.fromkeys(r for r in recipients.split(",") if r)), message=message
+    )
+
+
+def format_search_cursor(cursor: SearchCursor, /) -> str:
+    """
+    Encodes the given search cursor for clients, see `parse_search_cursor()`.
+    """
+    weights = ",".join(repr(weight) for weight in cursor.weights)
+    return f"{cursor.max_seq}:{cursor.score!r}:{cursor.seq}:{weights}"
+
+
+def parse_search_cursor(data: str, /) -> SearchCursor:
+    """
+    Decodes a search cursor that was created by `format_search_cursor()`.
+
+    Raises:
+        ValueError: If the given text is not a valid cursor.
+    """
+    max_seq, score, seq, weights = data.split(":")
+    return SearchCursor(
+        max_seq=int(max_seq),
+        weights=tuple(float(weight) for weight in weights.split(",")) if weights else (),
+        score=float(score),
+        seq=int(seq),
+    )
+
+
+def make_connection_manager_registry() -> ConnectionManagerRegistry:
+    """
+    Creates a connection manager registry for the chat API.
+    """
+    return ConnectionManagerRegistry(connection_manager_factory=lambda _key: PrioritizedConnectionManager())
+
+
+def make_reconnect_message(delay: float, /) -> str:
+    """
+    Creates a JSON message that asks the client to reconnect after the given delay.
+
+    Arguments:
+        delay: The number of seconds the client should wait before reconnecting.
+    """
+    return json.dumps({"reconnect": {"delay": delay}})
+
+
+def make_api(
+    *,
+    connection_manager_registry: ConnectionManagerRegistry | None = None,
+    room_directory: RoomDirectory | None = None,
+    message_index: MessageIndex | None = None,
+    message_pipeline: MessagePipeline | None = None,
+    message_tracer: MessageTracer | None = None,
+    poll_timeout: float = 25,
+    poll_client_idle_timeout: float = 60,
+    max_message_size: int = 64 * 1024,
+) -> APIRouter:
     """
     Creates an `APIRouter` with all the routes this module provides.
+
+    Besides web sockets, clients can also connect using server-sent events or long polling. These
+    clients receive messages from the same connection managers as web socket clients, and they send
+    messages with regular HTTP requests.
+
+    Arguments:
+        connection_manager_registry: The registry that holds the connection managers of the chat rooms.
+        room_directory: The directory that keeps track of the occupancy of the chat rooms.
+        message_index: The searchable history of the chat rooms.
+        message_pipeline: The filters and transformations incoming chat messages go through before delivery.
+        message_tracer: Optional tracer that samples chat messages for end-to-end tracing.
+        poll_timeout: The maximum number of seconds a poll (or an idle server-sent event stream) waits for messages.
+        poll_client_idle_timeout: The number of seconds after which long polling clients that stopped polling
+            are disconnected.
+        max_message_size: The maximum size of messages sent with HTTP requests in bytes, it should match the
+            maximum websocket message size of the server.
     """
 
     api = APIRouter()
 
-    connection_manager_registry = ConnectionManagerRegistry(
-        connection_manager_factory=lambda _key: WebSocketConnectionManager()
-    )
+    if connection_manager_registry is None:
+        connection_manager_registry = make_connection_manager_registry()
 
-    @api.websocket("/{room}/ws")
-    async def chat(
-        room: str,
-        connection: WebSocket,
-        user: User = Depends(requires_user_token),
-    ):
+    if room_directory is None:
+        room_directory = RoomDirectory()
+
+    if message_index is None:
+        message_index = MessageIndex()
+
+    if message_pipeline is None:
+        message_pipeline = MessagePipeline()
+
+    # Server-sent event and long polling clients by client ID.
+    buffered_connections: dict[str, tuple[RoomId, ChatUser, BufferedConnection]] = {}
+    # Idle timeout handles of long polling clients by client ID.
+    poll_client_expiry: dict[str, asyncio.TimerHandle] = {}
+    # Leave notifications that are sent outside of request handlers.
+    background_tasks: set[asyncio.Task] = set()
+
+    async def join(room: RoomId, connection: Connection, user: ChatUser) -> ConnectionManager:
+        """
+        Registers the given connection in the given room and notifies the members of the room.
+        """
         conn_manager = connection_manager_registry.ensure_connection_manager(room)
 
-        await conn_manager.connect(connection)
+        await conn_manager.connect(connection, user_id=user.email)
+        connection_manager_registry.notify_connect(room, user.email)
+        room_directory.update(room, len(conn_manager))
 
         await gather(
             # Announce the newly joined chat member.
             conn_manager.broadcast(
-                message=make_message(f"{user.name} ({user.email}) joined the chat.", user=user), skip=[connection]
+                message=make_message(f"{user.name} ({user.email}) joined the chat.", user=user),
+                skip=[connection],
+                priority=MessagePriority.CONTROL,
             ),
             # Send welcome message.
             conn_manager.send_personal_message(
                 message=make_message(f"Welcome to the chat {user.name} ({user.email}).", user=user, self=True),
                 connection=connection,
+                priority=MessagePriority.CONTROL,
             ),
         )
 
+        return conn_manager
+
+    async def receive(
+        room: RoomId, conn_manager: ConnectionManager, connection: Connection, user: ChatUser, data: str
+    ) -> None:
+        """
+        Delivers the given message received from the given connection, tracing it if it's sampled.
+        """
+        if data == "/typing":
+            await conn_manager.broadcast(
+                message=make_typing_message(user=user),
+                skip=[connection],
+                priority=MessagePriority.EPHEMERAL,
+                coalesce_key=user.email,
+            )
+            return
+
+        trace = None if message_tracer is None else message_tracer.sample()
+        if trace is None:
+            await deliver(room, conn_manager, connection, user, data, None)
+            return
+
+        trace.attributes.update({"lounge.room": room, "enduser.id": user.email, "lounge.message_size": len(data)})
+        # Connection managers find the trace in the context, including the tasks they create.
+        token = current_trace.set(trace)
+        try:
+            await deliver(room, conn_manager, connection, user, data, trace)
+        finally:
+            current_trace.reset(token)
+            trace.end()
+
+    async def deliver(
+        room: RoomId,
+        conn_manager: ConnectionManager,
+        connection: Connection,
+        user: ChatUser,
+        data: str,
+        trace: MessageTrace | None,
+    ) -> None:
+        """
+        Processes and delivers the given chat message, recording the stages in the given trace.
+        """
+        targeted = parse_targeted_message(data)
+        if trace is not None:
+            trace.lap("chat.parse")
+
+        processed = await message_pipeline.process(
+            PipelineMessage(room=room, user_email=user.email, text=data if targeted is None else targeted.message)
+        )
+        if trace is not None:
+            trace.lap("chat.filter")
+        if processed is None:  # Dropped by the pipeline.
+            return
+
+        text, mentions = processed.text, processed.mentions
+        if targeted is not None:
+            message = make_message(text, user=user, direct=True, room=room, mentions=mentions)
+            own_message = make_message(text, user=user, self=True, direct=True, room=room, mentions=mentions)
+            if trace is not None:
+                trace.lap("chat.encode")
+
+            delivery: Awaitable[Any]
+            if targeted.command == "/dm":  # Deliver to every room of the recipients.
+                delivery = gather(
+                    *(
+                        connection_manager_registry.send_direct_message(message=message, user_id=recipient)
+                        for recipient in targeted.recipients
+                    )
+                )
+            else:  # Deliver to the recipients in this room.
+                delivery = conn_manager.send_multicast_message(message=message, user_ids=targeted.recipients)
+
+            await gather(conn_manager.send_personal_message(message=own_message, connection=connection), delivery)
+            if trace is not None:
+                trace.lap("chat.fan_out")
+            return
+
+        message = make_message(text, user=user, mentions=mentions)
+        own_message = make_message(text, user=user, self=True, mentions=mentions)
+        if trace is not None:
+            trace.lap("chat.encode")
+
+        message_index.add(room, text, user_name=user.name, user_email=user.email)
+        if trace is not None:
+            trace.lap("chat.index")
+
+        await gather(
+            conn_manager.send_personal_message(message=own_message, connection=connection),
+            conn_manager.broadcast(message=message, skip=[connection]),
+        )
+        if trace is not None:
+            trace.lap("chat.fan_out")
+
+    def leave(
+        room: RoomId, conn_manager: ConnectionManager, connection: Connection, user: ChatUser
+    ) -> Awaitable[None]:
+        """
+        Unregisters the given connection and returns the awaitable that notifies the remaining members of the room.
+        """
+        conn_manager.disconnect(connection)
+        connection_manager_registry.notify_disconnect(room, user.email)
+        room_directory.update(room, len(conn_manager))
+        return conn_manager.broadcast(
+            message=make_message(f"{user.name} ({user.email}) left the chat.", user=user),
+            priority=MessagePriority.CONTROL,
+        )
+
+    def cancel_poll_client_expiry(client_id: str) -> None:
+        """
+        Stops the idle timeout of the given long polling client.
+        """
+        handle = poll_client_expiry.pop(client_id, None)
+        if handle is not None:
+            handle.cancel()
+
+    def leave_in_background(client_id: str) -> None:
+        """
+        Disconnects the server-sent event or long polling client with the given ID.
+        """
+        cancel_poll_client_expiry(client_id)
+
+        client = buffered_connections.pop(client_id, None)
+        if client is None:
+            return
+
+        room, user, connection = client
+        connection.close_nowait()
+        conn_manager = connection_manager_registry.get_connection_manager(room)
+        if conn_manager is None:
+            return
+
+        task = asyncio.ensure_future(leave(room, conn_manager, connection, user))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+    def get_buffered_connection(room: RoomId, client_id: str, user: User) -> BufferedConnection:
+        """
+        Returns the server-sent event or long polling client with the given ID.
+
+        Raises:
+            HTTPException: If the client doesn't exist or belongs to another room or user.
+        """
+        client = buffered_connections.get(client_id, None)
+        if client is None or client[0] != room or client[1].email != user.email:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown client.")
+
+        return client[2]
+
+    async def read_message(request: Request) -> str:
+        """
+        Reads the message in the body of the given request.
+
+        Raises:
+            HTTPException: If the body is larger than `max_message_size`.
+        """
+        too_large = HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Message too large.")
+        content_length = request.headers.get("content-length", None)
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_message_size:
+            raise too_large
+
+        body = bytearray()
+        async for chunk in request.stream():
+            body += chunk
+            if len(body) > max_message_size:
+                raise too_large
+
+        return body.decode()
+
+    def schedule_poll_client_expiry(client_id: str) -> None:
+        """
+        (Re)starts the idle timeout of the given long polling client.
+        """
+        cancel_poll_client_expiry(client_id)
+
+        poll_client_expiry[client_id] = asyncio.get_running_loop().call_later(
+            poll_client_idle_timeout, leave_in_background, client_id
+        )
+
+    @api.get("/rooms", response_model=list[RoomInfo], dependencies=[Depends(requires_user_token)])
+    async def list_rooms(prefix: str = "", after: str | None = None, limit: int = Query(default=50, ge=1, le=500)):
+        return [
+            RoomInfo(room=room, occupancy=occupancy)
+            for room, occupancy in room_directory.search(prefix, after=after, limit=limit)
+        ]
+
+    @api.get("/rooms/top", response_model=list[RoomInfo], dependencies=[Depends(requires_user_token)])
+    async def list_busiest_rooms(k: int = Query(default=10, ge=1, le=100)):
+        return [RoomInfo(room=room, occupancy=occupancy) for room, occupancy in room_directory.top(k)]
+
+    @api.get("/{room}/search", response_model=SearchResult, dependencies=[Depends(requires_user_token)])
+    async def search_messages(
+        room: str,
+        q: str = Query(min_length=1, max_length=256),
+        cursor: str | None = None,
+        limit: int = Query(default=20, ge=1, le=100),
+    ):
+        try:
+            page = message_index.search(
+                room, q, after=None if cursor is None else parse_search_cursor(cursor), limit=limit
+            )
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor.")
+
+        return SearchResult(
+            hits=[
+                SearchHitInfo(
+                    seq=hit.message.seq,
+                    created_at=hit.message.created_at,
+                    user=User(name=hit.message.user_name, email=hit.message.user_email),
+                    message=hit.message.text,
+                    score=hit.score,
+                )
+                for hit in page.hits
+            ],
+            cursor=None if page.cursor is None else format_search_cursor(page.cursor),
+        )
+
+    @api.websocket("/{room}/ws")
+    async def chat(
+        room: str,
+        connection: WebSocket,
+        chat_user: ChatUser = Depends(requires_websocket_chat_user),
+    ):
+        conn_manager = await join(room, connection, chat_user)
+
         try:
             while True:  # Start listening for messages.
                 data = await connection.receive_text()
-                await gather(
-                    conn_manager.send_personal_message(
-                        message=make_message(data, user=user, self=True), connection=connection
-                    ),
-                    conn_manager.broadcast(message=make_message(data, user=user), skip=[connection]),
-                )
+                await receive(room, conn_manager, connection, chat_user, data)
         except WebSocketDisconnect:
-            conn_manager.disconnect(connection)
-            await conn_manager.broadcast(
-                message=make_message(f"{user.name} ({user.email}) left the chat.", user=user)
-            )
-            connection_manager_registry.notify_disconnect(room)
+            pass
+        finally:
+            # Also leave if handling a message failed (e.g. a message filter raised), or the connection stays registered.
+            await leave(room, conn_manager, connection, chat_user)
+
+    @api.get("/{room}/sse")
+    async def chat_sse(room: str, user: User = Depends(requires_user_token)):
+        chat_user = ChatUser.intern(user)
+        connection = BufferedConnection(user_id=chat_user.email)
+
+        async def stream() -> AsyncIterator[str]:
+            cursor = 0
+            # Join in the stream, because the cleanup below never runs if the client disconnects before it starts.
+            buffered_connections[connection.client_id] = (room, chat_user, connection)
+            try:
+                await join(room, connection, chat_user)
+                # The client needs its ID to send messages.
+                yield f"event: client\ndata: {connection.client_id}\n\n"
+                while not connection.is_closed:
+                    messages = await connection.receive(cursor, timeout=poll_timeout)
+                    if not messages:
+                        yield ": keep-alive\n\n"
+                        continue
+
+                    cursor = messages[-1][0]
+                    yield "".join(f"id: {seq}\ndata: {message}\n\n" for seq, message in messages)
+            finally:
+                # The stream is cancelled when the client disconnects, so leave without awaiting.
+                leave_in_background(connection.client_id)
+
+        return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    @api.post("/{room}/poll", status_code=status.HTTP_201_CREATED)
+    async def chat_poll_connect(room: str, user: User = Depends(requires_user_token)):
+        chat_user = ChatUser.intern(user)
+        connection = BufferedConnection(user_id=chat_user.email)
+        buffered_connections[connection.client_id] = (room, chat_user, connection)
+        schedule_poll_client_expiry(connection.client_id)
+        await join(room, connection, chat_user)
+        return {"client_id": connection.client_id, "cursor": 0}
+
+    @api.get("/{room}/poll/{client_id}")
+    async def chat_poll(room: str, client_id: str, cursor: int = 0, user: User = Depends(requires_user_token)):
+        connection = get_buffered_connection(room, client_id, user)
+
+        # Don't expire the client while it's waiting for messages.
+        cancel_poll_client_expiry(client_id)
+        try:
+            messages = await connection.receive(cursor, timeout=poll_timeout)
+        finally:
+            if not connection.is_closed:
+                schedule_poll_client_expiry(client_id)
+
+        if connection.is_closed:
+            # Closed by the server, e.g. evicted for falling behind. Leave the room, and tell the client to
+            # reconnect instead of letting it poll a dead connection.
+            leave_in_background(client_id)
+            raise HTTPException(status_code=status.HTTP_410_GONE, detail="Client closed, reconnect.")
+
+        return {"cursor": messages[-1][0] if messages else cursor, "messages": [message for _, message in messages]}
+
+    @api.delete("/{room}/poll/{client_id}", status_code=status.HTTP_204_NO_CONTENT)
+    async def chat_poll_disconnect(room: str, client_id: str, user: User = Depends(requires_user_token)):
+        get_buffered_connection(room, client_id, user)
+        leave_in_background(client_id)
+
+    @api.post("/{room}/messages/{client_id}", status_code=status.HTTP_204_NO_CONTENT)
+    async def chat_send(room: str, client_id: str, request: Request, user: User = Depends(requires_user_token)):
+        connection = get_buffered_connection(room, client_id, user)
+        conn_manager = connection_manager_registry.get_connection_manager(room)
+        if conn_manager is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown client.")
+
+        await receive(room, conn_manager, connection, ChatUser.intern(user), await read_message(request))
 
     return api
@@ -1,11 +1,55 @@
-from typing import Hashable, Protocol
+from typing import Callable, Hashable, Protocol
 
 import asyncio
+from collections import deque
+from enum import IntEnum
+from time import perf_counter_ns
 
-from fastapi import WebSocket
+from .tracing import current_trace, MessageTrace
 
 
 Message = str
+UserId = Hashable  # Including None
+
+_NOT_REGISTERED = object()
+
+
+class MessagePriority(IntEnum):
+    """
+    Outbound message priorities.
+    """
+
+    CONTROL = 0
+    """
+    Control messages like join and leave notices. They are delivered before any other message.
+    """
+
+    CHAT = 1
+    """
+    Regular chat messages.
+    """
+
+    EPHEMERAL = 2
+    """
+    Lossy messages like typing indicators. Only the latest message is delivered for each coalesce key.
+    """
+
+
+class Connection(Protocol):
+    """
+    Client connection protocol.
+
+    `WebSocket` implements it, but any other transport can be managed by connection managers as well.
+    """
+
+    async def accept(self) -> None:
+        ...
+
+    async def send_text(self, data: str) -> None:
+        ...
+
+    async def close(self, code: int = 1000) -> None:
+        ...
 
 
 class ConnectionManager(Protocol):
@@ -22,70 +66,148 @@ class ConnectionManager(Protocol):
         """
         return len(self) == 0
 
-    async def connect(self, connection: WebSocket) -> None:
+    async def connect(self, connection: Connection, *, user_id: UserId = None) -> None:
         """
         Registers the given connection.
 
         Arguments:
             connection: The connection that should be registered.
+            user_id: The ID of the user who owns the connection.
         """
         ...
 
-    def disconnect(self, connection: WebSocket) -> None:
+    def disconnect(self, connection: Connection) -> None:
         """
-        Unregisters the given connection.
+        Unregisters the given connection. Unregistering a connection that is not registered is a no-op.
 
         Arguments:
             connection: The connection should be unregistered..
         """
         ...
 
-    async def send_group_message(self, *, message: Message, connections: list[WebSocket]) -> None:
+    async def close(self, *, code: int = 1000, make_farewell_message: Callable[[], Message] | None = None) -> None:
+        """
+        Unregisters and closes every connection.
+
+        Arguments:
+            code: The close code to send to the clients.
+            make_farewell_message: Optional function that creates the last message that is sent to a connection.
+                It is called once for every connection.
+        """
+        ...
+
+    def get_user_connections(self, user_id: UserId) -> list[Connection]:
+        """
+        Returns the connections of the given user.
+
+        Arguments:
+            user_id: The ID of the user whose connections should be returned.
+        """
+        ...
+
+    async def send_direct_message(self, *, message: Message, user_id: UserId) -> None:
+        """
+        Sends the given message to every connection of the given user.
+
+        Arguments:
+            message: The message to send.
+            user_id: The ID of the user the message should be sent to.
+        """
+        ...
+
+    async def send_multicast_message(self, *, message: Message, user_ids: list[UserId]) -> None:
+        """
+        Sends the given message to every connection of the given users.
+
+        Arguments:
+            message: The message to send.
+            user_ids: The IDs of the users the message should be sent to.
+        """
+        ...
+
+    async def send_group_message(
+        self,
+        *,
+        message: Message,
+        connections: list[Connection],
+        priority: MessagePriority = MessagePriority.CHAT,
+        coalesce_key: Hashable = None,
+    ) -> None:
         """
         Sends the given message to the given connections.
 
         Arguments:
             message: The message to send.
             connections: The connections the message should be sent to.
+            priority: The priority of the message.
+            coalesce_key: The key by which ephemeral messages are coalesced, typically the sender.
         """
         ...
 
-    async def send_personal_message(self, *, message: Message, connection: WebSocket) -> None:
+    async def send_personal_message(
+        self,
+        *,
+        message: Message,
+        connection: Connection,
+        priority: MessagePriority = MessagePriority.CHAT,
+        coalesce_key: Hashable = None,
+    ) -> None:
         """
         Sends the given message to the given connection.
 
         Arguments:
             message: The message to send.
             connection: The connection the message should be sent to.
+            priority: The priority of the message.
+            coalesce_key: The key by which ephemeral messages are coalesced, typically the sender.
         """
         ...
 
-    async def broadcast(self, *, message: Message, skip: list[WebSocket] = []) -> None:
+    async def broadcast(
+        self,
+        *,
+        message: Message,
+        skip: list[Connection] = [],
+        priority: MessagePriority = MessagePriority.CHAT,
+        coalesce_key: Hashable = None,
+    ) -> None:
         """
         Sends to given message to every connection except the ones in `skip`.
 
         Arguments:
             message: The message to broadcast.
             skip: The connections that should be overlooked.
+            priority: The priority of the message.
+            coalesce_key: The key by which ephemeral messages are coalesced, typically the sender.
         """
         ...
 
 
 class WebSocketConnectionManager(ConnectionManager):
     """
-    Default web socket connection manager implementation.
+    Default connection manager implementation, primarily for web sockets.
 
     All messages are ultimately sent using the `_send_message()` method to make it easy
     to hook into the message sending process.
+
+    Connections are also indexed by user, so the cost of direct and multicast messages is
+    proportional to the number of recipients, not the number of connections.
     """
 
-    __slots__ = ("_active_connections",)
+    __slots__ = (
+        "_active_connections",
+        "_connection_users",
+        "_user_connections",
+    )
 
     def __init__(self):
         """
         Initialization.
         """
-        self._active_connections: list[WebSocket] = []
+        self._active_connections: list[Connection] = []
+        # WebSocket is not hashable, connections are identified by their id().
+        self._connection_users: dict[int, UserId] = {}
+        self._user_connections: dict[UserId, list[Connection]] = {}
 
     def __len__(self) -> int:
         """
@@ -93,56 +215,414 @@ class WebSocketConnectionManager(ConnectionManager):
         """
         return len(self._active_connections)
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: Connection, *, user_id: UserId = None):
         """
         Inherited.
         """
         await websocket.accept()
         self._active_connections.append(websocket)
+        self._connection_users[id(websocket)] = user_id
+        self._user_connections.setdefault(user_id, []).append(websocket)
 
-    def disconnect(self, websocket: WebSocket):
+    def disconnect(self, websocket: Connection):
         """
         Inherited.
         """
+        if id(websocket) not in self._connection_users:
+            return
+
         self._active_connections.remove(websocket)
+        user_id = self._connection_users.pop(id(websocket))
+        user_connections = self._user_connections[user_id]
+        user_connections.remove(websocket)
+        if not user_connections:
+            del self._user_connections[user_id]
+
+    async def close(self, *, code: int = 1000, make_farewell_message: Callable[[], Message] | None = None) -> None:
+        """
+        Inherited.
+        """
+        connections = self._active_connections
+        # Unregister all connections first, so they don't receive messages while they are being closed.
+        self._active_connections = []
+        self._connection_users.clear()
+        self._user_connections.clear()
+
+        async def close(connection: Connection) -> None:
+            if make_farewell_message is not None:
+                await self._send_message(message=make_farewell_message(), connection=connection)
+            await connection.close(code)
+
+        await asyncio.gather(*(close(conn) for conn in connections), return_exceptions=True)
 
-    async def _send_message(self, *, message: Message, connection: WebSocket) -> None:
+    def get_user_connections(self, user_id: UserId) -> list[Connection]:
+        """
+        Inherited.
+        """
+        return list(self._user_connections.get(user_id, ()))
+
+    async def _send_message(
+        self,
+        *,
+        message: Message,
+        connection: Connection,
+        priority: MessagePriority = MessagePriority.CHAT,
+        coalesce_key: Hashable = None,
+    ) -> None:
         """
         Corutine that sends the given message on the given connection.
 
         All other messaging methods must call this one to actually send a message. The goal
         is to make it easy to hook into the message sending process.
 
+        This implementation sends every message immediately, regardless of its priority.
+
         Arguments:
             message: The message to send.
+            connection: The connection the message should be sent to.
+            priority: The priority of the message.
+            coalesce_key: The key by which ephemeral messages are coalesced, typically the sender.
+        """
+        trace = current_trace.get()
+        if trace is None:
+            await connection.send_text(message)
+            return
+
+        trace.begin_delivery()
+        started_at = perf_counter_ns()
+        delivered = False
+        try:
+            await connection.send_text(message)
+            delivered = True
+        finally:
+            trace.end_delivery(
+                recipient=self._connection_users.get(id(connection), None),
+                queued_at=started_at,
+                sent_at=started_at,
+                delivered=delivered,
+            )
+
+    async def send_group_message(
+        self,
+        *,
+        message: Message,
+        connections: list[Connection],
+        priority: MessagePriority = MessagePriority.CHAT,
+        coalesce_key: Hashable = None,
+    ) -> None:
+        """
+        Inherited.
+        """
+        await asyncio.gather(
+            *(
+                self._send_message(message=message, connection=conn, priority=priority, coalesce_key=coalesce_key)
+                for conn in connections
+            )
+        )
+
+    async def send_personal_message(
+        self,
+        *,
+        message: Message,
+        connection: Connection,
+        priority: MessagePriority = MessagePriority.CHAT,
+        coalesce_key: Hashable = None,
+    ):
+        """
+        Inherited.
         """
-        await connection.send_text(message)
+        await self._send_message(message=message, connection=connection, priority=priority, coalesce_key=coalesce_key)
 
-    async def send_group_message(self, *, message: Message, connections: list[WebSocket]) -> None:
+    async def send_direct_message(self, *, message: Message, user_id: UserId) -> None:
         """
         Inherited.
         """
-        await asyncio.gather(*(self._send_message(message=message, connection=conn) for conn in connections))
+        await self.send_group_message(message=message, connections=self._user_connections.get(user_id, []))
 
-    async def send_personal_message(self, *, message: Message, connection: WebSocket):
+    async def send_multicast_message(self, *, message: Message, user_ids: list[UserId]) -> None:
         """
         Inherited.
         """
-        await self._send_message(message=message, connection=connection)
+        user_connections = self._user_connections
+        await self.send_group_message(
+            message=message,
+            connections=[
+                conn for user_id in set(user_ids) if user_id in user_connections for conn in user_connections[user_id]
+            ],
+        )
 
-    async def broadcast(self, *, message: Message, skip: list[WebSocket] = []):
+    async def broadcast(
+        self,
+        *,
+        message: Message,
+        skip: list[Connection] = [],
+        priority: MessagePriority = MessagePriority.CHAT,
+        coalesce_key: Hashable = None,
+    ):
         """
         Inherited.
         """
         await asyncio.gather(
             *(
-                self._send_message(message=message, connection=conn)
+                self._send_message(message=message, connection=conn, priority=priority, coalesce_key=coalesce_key)
                 for conn in self._active_connections
                 if conn not in skip
             )
         )
 
 
+class _OutboundQueue:
+    """
+    Prioritized outbound message queue of a connection.
+    """
+
+    __slots__ = (
+        "chat",
+        "control",
+        "ephemeral",
+        "evicted",
+        "traced",
+        "user_id",
+        "writer",
+    )
+
+    def __init__(self, *, max_chat_backlog: int, user_id: UserId) -> None:
+        self.control: deque[Message] = deque()
+        self.chat: deque[Message] = deque(maxlen=max_chat_backlog)
+        self.ephemeral: dict[Hashable, Message] = {}
+        self.writer: asyncio.Task | None = None
+        self.user_id = user_id
+        # Whether the connection is being closed because it fell too far behind.
+        self.evicted = False
+        # Queued messages that are being traced by id(), with their trace and queueing time.
+        # Only exists while such messages are queued, so untraced messages only pay for a `None` check.
+        self.traced: dict[int, tuple[Message, MessageTrace, int]] | None = None
+
+    def push(self, message: Message, priority: MessagePriority, coalesce_key: Hashable) -> None:
+        """
+        Adds the given message to the lane that corresponds to its priority.
+        """
+        if priority == MessagePriority.CONTROL:
+            self.control.append(message)
+        elif priority == MessagePriority.CHAT:
+            chat = self.chat
+            if self.traced is not None and len(chat) == chat.maxlen:
+                self.untrack(chat[0], sent_at=None)  # The oldest message is dropped.
+            chat.append(message)
+        else:
+            # Replace any pending message with the same key, and move the key to the end.
+            replaced = self.ephemeral.pop(coalesce_key, None)
+            if replaced is not None and self.traced is not None:
+                self.untrack(replaced, sent_at=None)
+            self.ephemeral[coalesce_key] = message
+
+    def pop(self) -> Message | None:
+        """
+        Removes and returns the next message to send, or returns `None` if the queue is empty.
+        """
+        if self.control:
+            return self.control.popleft()
+        if self.chat:
+            return self.chat.popleft()
+        if self.ephemeral:
+            return self.ephemeral.pop(next(iter(self.ephemeral)))
+        return None
+
+    def clear(self) -> None:
+        """
+        Removes every pending message.
+        """
+        self.control.clear()
+        self.chat.clear()
+        self.ephemeral.clear()
+        if self.traced is not None:
+            for message, _, _ in list(self.traced.values()):
+                self.untrack(message, sent_at=None)
+
+    def track(self, message: Message, trace: MessageTrace) -> None:
+        """
+        Records that the given queued message belongs to the given trace.
+        """
+        if self.traced is None:
+            self.traced = {}
+        elif id(message) in self.traced:
+            return  # Already queued, only the first delivery is traced.
+
+        trace.begin_delivery()
+        # The entry keeps the message alive, so its id() can't be reused while it's in the table.
+        self.traced[id(message)] = (message, trace, perf_counter_ns())
+
+    def untrack(self, message: Message, *, sent_at: int | None) -> None:
+        """
+        Records the end of the delivery of the given message if it's traced.
+
+        Arguments:
+            message: The message that was sent or dropped.
+            sent_at: The `perf_counter_ns()` time when sending the message started, `None` if it was dropped.
+        """
+        traced = self.traced
+        entry = None if traced is None else traced.get(id(message), None)
+        if entry is None or entry[0] is not message:
+            return
+
+        del traced[id(message)]  # type: ignore[union-attr]
+        if not traced:
+            self.traced = None
+
+        _, trace, queued_at = entry
+        trace.end_delivery(
+            recipient=self.user_id,
+            queued_at=queued_at,
+            sent_at=queued_at if sent_at is None else sent_at,
+            delivered=sent_at is not None,
+        )
+
+
+class PrioritizedConnectionManager(WebSocketConnectionManager):
+    """
+    Connection manager that queues outbound messages per connection in priority lanes.
+
+    Control messages are sent before chat messages, and chat messages before ephemeral ones.
+    Ephemeral messages are coalesced, only the latest one is kept for each coalesce key. The
+    chat lane is bounded, when a client falls too far behind, its oldest chat messages are dropped.
+    Control messages can't be dropped, so a client whose control backlog reaches its limit is
+    closed with code 1013 (try again later) and left to reconnect.
+
+    Sending a message only queues it, so slow clients don't hold up the sender. Each connection
+    with pending messages has a queue and a writer task. Both are dropped when the queue is drained,
+    so idle connections don't pay for them.
+    """
+
+    __slots__ = (
+        "_max_chat_backlog",
+        "_max_control_backlog",
+        "_outbound",
+    )
+
+    def __init__(self, *, max_chat_backlog: int = 256, max_control_backlog: int = 256):
+        """
+        Initialization.
+
+        Arguments:
+            max_chat_backlog: The maximum number of queued chat messages per connection.
+            max_control_backlog: The maximum number of queued control messages per connection.
+        """
+        super().__init__()
+        self._max_chat_backlog = max_chat_backlog
+        self._max_control_backlog = max_control_backlog
+        # The queues of the connections that have pending messages or are being evicted, by id().
+        self._outbound: dict[int, _OutboundQueue] = {}
+
+    def disconnect(self, websocket: Connection):
+        """
+        Inherited.
+        """
+        super().disconnect(websocket)
+        queue = self._outbound.pop(id(websocket), None)
+        if queue is not None:
+            if queue.writer is not None:
+                queue.writer.cancel()
+            queue.clear()
+
+    async def close(self, *, code: int = 1000, make_farewell_message: Callable[[], Message] | None = None) -> None:
+        """
+        Inherited.
+        """
+        # Farewell messages are sent directly once the queues are gone.
+        for queue in self._outbound.values():
+            if queue.writer is not None:
+                queue.writer.cancel()
+            queue.clear()
+        self._outbound.clear()
+
+        await super().close(code=code, make_farewell_message=make_farewell_message)
+
+    async def _send_message(
+        self,
+        *,
+        message: Message,
+        connection: Connection,
+        priority: MessagePriority = MessagePriority.CHAT,
+        coalesce_key: Hashable = None,
+    ) -> None:
+        """
+        Inherited.
+
+        Queues the message and makes sure the connection has a writer task.
+        """
+        key = id(connection)
+        user_id = self._connection_users.get(key, _NOT_REGISTERED)
+        if user_id is _NOT_REGISTERED:  # Not (or no longer) registered.
+            await connection.send_text(message)
+            return
+
+        queue = self._outbound.get(key, None)
+        if queue is None:
+            queue = self._outbound[key] = _OutboundQueue(max_chat_backlog=self._max_chat_backlog, user_id=user_id)
+        elif queue.evicted:
+            return
+
+        if priority == MessagePriority.CONTROL and len(queue.control) >= self._max_control_backlog:
+            self._evict(connection, queue)
+            return
+
+        queue.push(message, priority, coalesce_key)
+        if (trace := current_trace.get()) is not None:
+            queue.track(message, trace)
+        if queue.writer is None:
+            queue.writer = asyncio.create_task(self._write(connection, queue))
+
+    def _evict(self, connection: Connection, queue: _OutboundQueue) -> None:
+        """
+        Drops the queued messages of the given connection and closes it in the background.
+
+        The connection stays registered until its receive loop disconnects it.
+        """
+        queue.evicted = True
+        if queue.writer is not None:
+            queue.writer.cancel()
+        queue.clear()
+        queue.writer = asyncio.create_task(self._close_evicted(connection))
+
+    async def _close_evicted(self, connection: Connection) -> None:
+        """
+        Task that closes a connection that fell too far behind.
+        """
+        try:
+            await connection.close(code=1013)  # Try again later.
+        except Exception:
+            pass  # Already closed.
+
+    async def _write(self, connection: Connection, queue: _OutboundQueue) -> None:
+        """
+        Writer task that sends the queued messages of the given connection until the queue is empty,
+        then drops the queue.
+        """
+        try:
+            while (message := queue.pop()) is not None:
+                if queue.traced is None:
+                    await connection.send_text(message)
+                    continue
+
+                sent_at = perf_counter_ns()
+                try:
+                    await connection.send_text(message)
+                except BaseException:
+                    queue.untrack(message, sent_at=None)
+                    raise
+                queue.untrack(message, sent_at=sent_at)
+        except Exception:
+            # The connection is broken, its receive loop will disconnect it.
+            queue.clear()
+        finally:
+            if queue.writer is asyncio.current_task():  # Not replaced by `_evict()`.
+                queue.writer = None
+                # The queue is empty, unless the connection was disconnected and the queue is already gone.
+                key = id(connection)
+                if self._outbound.get(key, None) is queue:
+                    del self._outbound[key]
+
+
 ConnectionManagerRegistryKey = Hashable  # Including None
 
 
@@ -158,11 +638,15 @@ class ConnectionManagerFactory(Protocol):
 class ConnectionManagerRegistry:
     """
     Registry that associates connection managers with unique keys.
+
+    The registry also keeps track of which connection managers each user is connected to,
+    so the connections of a user can be found without scanning every connection manager.
     """
 
     __slots__ = (
         "_connection_managers",
         "_make_connection_manager",
+        "_user_keys",
     )
 
     def __init__(self, *, connection_manager_factory: ConnectionManagerFactory) -> None:
@@ -174,6 +658,7 @@ class ConnectionManagerRegistry:
         """
         self._make_connection_manager: ConnectionManagerFactory = connection_manager_factory
         self._connection_managers: dict[ConnectionManagerRegistryKey, ConnectionManager] = {}
+        self._user_keys: dict[UserId, set[ConnectionManagerRegistryKey]] = {}
 
     def cleanup(self) -> list[ConnectionManagerRegistryKey]:
         """
@@ -186,6 +671,22 @@ class ConnectionManagerRegistry:
 
         return result
 
+    async def close(self, *, code: int = 1000, make_farewell_message: Callable[[], Message] | None = None) -> None:
+        """
+        Closes and removes all connection managers.
+
+        Arguments:
+            code: The close code to send to the clients.
+            make_farewell_message: Optional function that creates the last message that is sent to a connection.
+                It is called once for every connection.
+        """
+        connection_managers = list(self._connection_managers.values())
+        self._connection_managers.clear()
+        self._user_keys.clear()
+        await asyncio.gather(
+            *(cm.close(code=code, make_farewell_message=make_farewell_message) for cm in connection_managers)
+        )
+
     def ensure_connection_manager(self, key: ConnectionManagerRegistryKey) -> ConnectionManager:
         """
         Returns the connection manager that is registered with the given key, creating and registering
@@ -208,7 +709,48 @@ class ConnectionManagerRegistry:
         """
         return self._connection_managers.get(key, None)
 
-    def notify_disconnect(self, key: ConnectionManagerRegistryKey) -> None:
+    def get_user_connections(self, user_id: UserId) -> list[Connection]:
+        """
+        Returns the connections of the given user from all connection managers.
+
+        Arguments:
+            user_id: The ID of the user whose connections should be returned.
+        """
+        connection_managers = self._connection_managers
+        return [
+            conn
+            for key in self._user_keys.get(user_id, ())
+            for conn in connection_managers[key].get_user_connections(user_id)
+        ]
+
+    async def send_direct_message(self, *, message: Message, user_id: UserId) -> None:
+        """
+        Sends the given message to every connection of the given user in all connection managers.
+
+        Arguments:
+            message: The message to send.
+            user_id: The ID of the user the message should be sent to.
+        """
+        connection_managers = self._connection_managers
+        await asyncio.gather(
+            *(
+                connection_managers[key].send_direct_message(message=message, user_id=user_id)
+                for key in self._user_keys.get(user_id, ())
+            )
+        )
+
+    def notify_connect(self, key: ConnectionManagerRegistryKey, user_id: UserId = None) -> None:
+        """
+        Notifies the registry that a client connected to the connection manager that is
+        registered with the given key.
+
+        Arguments:
+            key: The key of the connection manager to which a client connected.
+            user_id: The ID of the user who connected.
+        """
+        self._user_keys.setdefault(user_id, set()).add(key)
+
+    def notify_disconnect(self, key: ConnectionManagerRegistryKey, user_id: UserId = None) -> None:
         """
         Notifies the registry that a client disconnected from the connection manager that is
         registered with the given key.
@@ -217,7 +759,15 @@ class ConnectionManagerRegistry:
 
         Arguments:
             key: The key of the connection manager from which a client disconnected.
+            user_id: The ID of the user who disconnected.
         """
         conn_manager = self._connection_managers.get(key, None)
+
+        user_keys = self._user_keys.get(user_id, None)
+        if user_keys is not None and (conn_manager is None or not conn_manager.get_user_connections(user_id)):
+            user_keys.discard(key)
+            if not user_keys:
+                del self._user_keys[user_id]
+
         if conn_manager and conn_manager.is_empty:
             del self._connection_managers[key]
@@ -1,14 +1,29 @@
 from __future__ import annotations
 from typing import Protocol
 
+import asyncio
+from secrets import token_urlsafe
 import time
 
-from fastapi import APIRouter, Cookie, Depends, HTTPException, Request, Response, status
+from fastapi import APIRouter, Cookie, Depends, HTTPException, Request, Response, status, WebSocket
 from fastapi.responses import RedirectResponse
 from jose import JWTError
 from pydantic import BaseModel, EmailStr, ValidationError
 
 from .jwt import get_jwt_decoder, get_jwt_encoder, JWTDecoder, JWTEncoder
+from .revocation import get_revocation_store, RevocationStore
+from .settings import get_settings
+
+
+EMAIL_TOKEN_LIFETIME = 150
+"""
+The number of seconds an auth email token is valid for.
+"""
+
+USER_TOKEN_LIFETIME = 30 * 24 * 60 * 60
+"""
+The number of seconds a user token is valid for.
+"""
 
 
 class User(BaseModel):
@@ -34,7 +49,7 @@ class EmailToken(User):
         Creates a new token from the given user data.
         """
         now = time.time()
-        return cls(name=data.name, email=data.email, iat=now, exp=now + 150)  # Valid for 2.5 minutes.
+        return cls(name=data.name, email=data.email, iat=now, exp=now + EMAIL_TOKEN_LIFETIME)
 
 
 class UserToken(User):
@@ -43,13 +58,21 @@ class UserToken(User):
     """
 
     created_at: float
+    exp: float
+    jti: str
+    """
+    Unique token ID, used for revocation.
+    """
 
     @classmethod
     def from_email_token(cls, token: EmailToken) -> UserToken:
         """
         Creates a new user token from the given email token.
         """
-        return cls(name=token.name, email=token.email, created_at=time.time())
+        now = time.time()
+        return cls(
+            name=token.name, email=token.email, created_at=now, exp=now + USER_TOKEN_LIFETIME, jti=token_urlsafe(16)
+        )
 
 
 class TokenAuthErrorHandler(Protocol):
@@ -70,27 +93,31 @@ class LoginEmailSender(Protocol):
         ...
 
 
-__USER_TOKEN_COOKIE = "X-User"
+USER_TOKEN_COOKIE = "X-User"
 
 
 def get_user_token(
-    user_token_cookie: str | None = Cookie(alias=__USER_TOKEN_COOKIE, default=None),
+    user_token_cookie: str | None = Cookie(alias=USER_TOKEN_COOKIE, default=None),
     decode_jwt: JWTDecoder = Depends(get_jwt_decoder),
+    revocation_store: RevocationStore = Depends(get_revocation_store),
 ) -> UserToken | None:
     """
     Dependency that returns the user token from the current request if there is one.
 
     Returns:
-        The user token that was included in the request or `None` if there was no token or if it was invalid.
+        The user token that was included in the request or `None` if there was no token or if it was invalid,
+        expired or revoked.
     """
     if user_token_cookie is None:
         return None
 
     try:
-        return UserToken(**decode_jwt(user_token_cookie))
+        token = UserToken(**decode_jwt(user_token_cookie))
     except (JWTError, ValidationError):
         return None
 
+    return None if revocation_store.is_revoked(token.jti) else token
+
 
 def requires_user_token(token: UserToken | None = Depends(get_user_token)) -> UserToken:
     """
@@ -111,6 +138,33 @@ def requires_user_token(token: UserToken | None = Depends(get_user_token)) -> Us
     return token
 
 
+def get_websocket_user_token(websocket: WebSocket) -> UserToken | None:
+    """
+    Dependency that returns the user token of the current websocket connection if there is one.
+
+    Unlike `get_user_token()`, it doesn't have sub-dependencies.
+
+    Returns:
+        The user token that was included in the request or `None` if there was no token or if it was invalid.
+    """
+    return get_user_token(
+        websocket.cookies.get(USER_TOKEN_COOKIE), get_jwt_decoder(get_settings()), get_revocation_store()
+    )
+
+
+def requires_websocket_user_token(token: UserToken | None = Depends(get_websocket_user_token)) -> UserToken:
+    """
+    Websocket version of `requires_user_token()`.
+
+    Returns:
+        The user token that was parsed from the request.
+
+    Raises:
+        HTTPException: If the request doesn't contain a valid user token.
+    """
+    return requires_user_token(token)
+
+
 def make_api(
     *,
     app_redirect_url: str,
@@ -154,13 +208,20 @@ def make_api(
         user_cookie = UserToken.from_email_token(email_token)
 
         response = RedirectResponse(app_redirect_url)
-        response.set_cookie(__USER_TOKEN_COOKIE, encode_jwt(user_cookie.dict()))
+        response.set_cookie(USER_TOKEN_COOKIE, encode_jwt(user_cookie.dict()))
         return response
 
     @api.get("/email-logout")
-    async def email_logout():
+    async def email_logout(
+        user_token: UserToken | None = Depends(get_user_token),
+        revocation_store: RevocationStore = Depends(get_revocation_store),
+    ):
+        if user_token is not None:
+            # Revoking locks and appends to the revocation file, keep it off the event loop.
+            await asyncio.to_thread(revocation_store.revoke, user_token.jti, user_token.exp)
+
         response = RedirectResponse(app_redirect_url)
-        response.delete_cookie(__USER_TOKEN_COOKIE)
+        response.delete_cookie(USER_TOKEN_COOKIE)
         return response
 
     @api.get("/whoami", response_model=User)
@@ -0,0 +1,318 @@
+from __future__ import annotations
+from typing import AsyncIterator, NamedTuple, Protocol
+
+import asyncio
+from contextlib import asynccontextmanager
+from email.message import EmailMessage
+import logging
+import time
+
+import aiosmtplib
+from fastapi import HTTPException, status
+
+from .email_auth_api import EMAIL_TOKEN_LIFETIME, User
+
+_logger = logging.getLogger(__name__)
+
+
+class LoginEmail(NamedTuple):
+    """
+    A queued login email.
+    """
+
+    user: User
+    token: str
+    request_url: str
+
+    @property
+    def login_url(self) -> str:
+        """
+        The URL the user must visit to log in.
+        """
+        return f"{self.request_url}email-authorize/{self.token}"
+
+
+class LoginEmailTransport(Protocol):
+    """
+    Login email transport protocol.
+
+    Transports receive batches of login emails and must raise an exception if a batch could not be delivered.
+    """
+
+    async def __call__(self, emails: list[LoginEmail]) -> None:
+        ...
+
+
+async def print_login_emails(emails: list[LoginEmail]) -> None:
+    """
+    Development transport that prints the login URLs instead of sending emails.
+    """
+    for email in emails:
+        print(f"LOGIN AT: {email.login_url}")
+
+
+class SMTPConnectionPool:
+    """
+    Pool of reusable SMTP connections that implements the `LoginEmailTransport` protocol.
+
+    Connections are opened lazily, kept alive between batches, and dropped (to be reopened
+    on demand) if a send fails on them.
+    """
+
+    __slots__ = (
+        "_connections",
+        "_hostname",
+        "_password",
+        "_port",
+        "_sender",
+        "_start_tls",
+        "_username",
+    )
+
+    def __init__(
+        self,
+        *,
+        hostname: str,
+        port: int,
+        sender: str,
+        username: str | None = None,
+        password: str | None = None,
+        start_tls: bool = True,
+        size: int = 4,
+    ) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            hostname: The hostname of the SMTP server.
+            port: The port of the SMTP server.
+            sender: The address login emails are sent from.
+            username: Optional SMTP username.
+            password: Optional SMTP password.
+            start_tls: Whether to upgrade connections with STARTTLS.
+            size: The maximum number of open connections.
+        """
+        self._hostname = hostname
+        self._port = port
+        self._sender = sender
+        self._username = username
+        self._password = password
+        self._start_tls = start_tls
+        self._connections: asyncio.LifoQueue[aiosmtplib.SMTP | None] = asyncio.LifoQueue(maxsize=size)
+        for _ in range(size):
+            # None marks a free slot without an open connection.
+            self._connections.put_nowait(None)
+
+    async def __call__(self, emails: list[LoginEmail]) -> None:
+        """
+        Sends the given emails on a single pooled connection.
+        """
+        async with self._acquire() as smtp:
+            for email in emails:
+                await smtp.send_message(self._make_message(email))
+
+    async def close(self) -> None:
+        """
+        Closes all idle connections.
+        """
+        for _ in range(self._connections.qsize()):
+            smtp = self._connections.get_nowait()
+            if smtp is not None and smtp.is_connected:
+                try:
+                    await smtp.quit()
+                except aiosmtplib.SMTPException:
+                    smtp.close()
+            self._connections.put_nowait(None)
+
+    @asynccontextmanager
+    async def _acquire(self) -> AsyncIterator[aiosmtplib.SMTP]:
+        """
+        Context manager that borrows a connected SMTP client from the pool.
+        """
+        smtp = await self._connections.get()
+        try:
+            if smtp is None or not smtp.is_connected:
+                smtp = await self._connect()
+            yield smtp
+        except BaseException:
+            if smtp is not None:
+                smtp.close()
+            smtp = None
+            raise
+        finally:
+            self._connections.put_nowait(smtp)
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        """
+        Opens and authenticates a new SMTP connection.
+        """
+        smtp = aiosmtplib.SMTP(hostname=self._hostname, port=self._port, start_tls=self._start_tls)
+        await smtp.connect()
+        if self._username is not None and self._password is not None:
+            await smtp.login(self._username, self._password)
+        return smtp
+
+    def _make_message(self, email: LoginEmail) -> EmailMessage:
+        """
+        Creates the email message for the given login email.
+        """
+        message = EmailMessage()
+        message["From"] = self._sender
+        message["To"] = email.user.email
+        message["Subject"] = "Lounge login"
+        message.set_content(f"Hi {email.user.name},\n\nLog in to Lounge at: {email.login_url}\n")
+        return message
+
+
+class LoginEmailDispatcher:
+    """
+    Background login email queue that implements the `LoginEmailSender` protocol.
+
+    Calling the dispatcher only enqueues the email, the actual sending is done by a pool of worker
+    tasks that send emails in batches and retry failed batches with exponential backoff.
+
+    Repeated login requests for the same email address are ignored until the previously sent token
+    expires, and both the queue and the deduplication table have a bounded size.
+    """
+
+    __slots__ = (
+        "_backoff",
+        "_batch_size",
+        "_max_retries",
+        "_queue",
+        "_recent",
+        "_recent_limit",
+        "_send",
+        "_worker_count",
+        "_workers",
+    )
+
+    def __init__(
+        self,
+        *,
+        transport: LoginEmailTransport,
+        worker_count: int = 4,
+        batch_size: int = 16,
+        max_queue_size: int = 1024,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        dedup_limit: int = 16384,
+    ) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            transport: The transport that delivers batches of login emails.
+            worker_count: The number of worker tasks.
+            batch_size: The maximum number of emails a worker sends in one batch.
+            max_queue_size: The maximum number of emails waiting in the queue.
+            max_retries: The number of times a failed batch is retried.
+            backoff: The delay before the first retry in seconds, doubled after every failed attempt.
+            dedup_limit: The maximum number of email addresses remembered for deduplication.
+        """
+        self._send = transport
+        self._worker_count = worker_count
+        self._batch_size = batch_size
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._recent_limit = dedup_limit
+        self._queue: asyncio.Queue[LoginEmail] = asyncio.Queue(maxsize=max_queue_size)
+        self._recent: dict[str, float] = {}  # Email -> expiry, in insertion (and therefore expiry) order.
+        self._workers: list[asyncio.Task] = []
+
+    async def __call__(self, *, user: User, token: str, request_url: str) -> None:
+        """
+        Enqueues a login email for the given user.
+
+        Raises:
+            HTTPException: If the queue is full.
+        """
+        now = time.time()
+        self._forget_expired(now)
+
+        if user.email in self._recent:
+            return
+
+        try:
+            self._queue.put_nowait(LoginEmail(user=user, token=token, request_url=request_url))
+        except asyncio.QueueFull:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many pending login requests.",
+            )
+
+        if len(self._recent) >= self._recent_limit:
+            del self._recent[next(iter(self._recent))]
+        self._recent[user.email] = now + EMAIL_TOKEN_LIFETIME
+
+    async def start(self) -> None:
+        """
+        Starts the worker tasks.
+        """
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._work()) for _ in range(self._worker_count)]
+
+    async def stop(self, *, timeout: float = 5) -> None:
+        """
+        Waits for the queued emails to be sent and stops the worker tasks.
+
+        Arguments:
+            timeout: The maximum number of seconds to wait for the queue to drain. The emails that
+                are still queued or being sent when it expires are dropped.
+        """
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            _logger.warning("Dropping %d unsent login email(s) on shutdown.", self._queue.qsize())
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def _forget_expired(self, now: float) -> None:
+        """
+        Removes the expired entries from the deduplication table.
+        """
+        recent = self._recent
+        while recent:
+            email = next(iter(recent))
+            if recent[email] > now:
+                break
+            del recent[email]
+
+    async def _work(self) -> None:
+        """
+        Worker task that sends the queued emails in batches.
+        """
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self._batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            try:
+                await self._send_with_retry(batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _send_with_retry(self, batch: list[LoginEmail]) -> None:
+        """
+        Sends the given batch, retrying with exponential backoff if sending fails.
+        """
+        delay = self._backoff
+        for attempt in range(self._max_retries + 1):
+            try:
+                await self._send(batch)
+                return
+            except Exception:
+                if attempt == self._max_retries:
+                    _logger.exception("Failed to send %d login email(s).", len(batch))
+                    for email in batch:
+                        # Let the user request a new email right away.
+                        self._recent.pop(email.user.email, None)
+                    return
+
+                await asyncio.sleep(delay)
+                delay *= 2
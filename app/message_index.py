@@ -0,0 +1,428 @@
+from __future__ import annotations
+from typing import Any, Iterator, NamedTuple
+
+from collections import OrderedDict
+from heapq import nsmallest
+import math
+import re
+import time
+
+_token_pattern = re.compile(r"\w+")
+
+
+def tokenize(text: str, /) -> set[str]:
+    """
+    Returns the distinct, lowercase search terms of the given text.
+
+    Arguments:
+        text: The text to tokenize.
+    """
+    return {token for token in _token_pattern.findall(text.lower()) if len(token) <= 64}
+
+
+class IndexedMessage(NamedTuple):
+    """
+    A message in the room history.
+    """
+
+    seq: int
+    created_at: float
+    user_name: str
+    user_email: str
+    text: str
+
+
+class SearchHit(NamedTuple):
+    """
+    A search result.
+    """
+
+    score: float
+    message: IndexedMessage
+
+
+class SearchCursor(NamedTuple):
+    """
+    Pagination cursor of a search.
+
+    The cursor pins the ranking of the first page: later pages only consider the messages that existed
+    when the search started, and score them with the term weights of the first page. This way the
+    order of the hits doesn't change between pages while new messages are indexed.
+    """
+
+    max_seq: int
+    """
+    The sequence number of the last message when the search started.
+    """
+
+    weights: tuple[float, ...]
+    """
+    The inverse document frequencies of the (sorted) query terms when the search started.
+    """
+
+    score: float
+    """
+    The score of the last hit of the previous page.
+    """
+
+    seq: int
+    """
+    The sequence number of the last hit of the previous page.
+    """
+
+
+class SearchPage(NamedTuple):
+    """
+    A page of search results.
+    """
+
+    hits: list[SearchHit]
+    cursor: SearchCursor | None
+    """
+    The cursor of the next page, `None` if there are no more hits.
+    """
+
+
+class _Postings:
+    """
+    Compressed posting list: the ascending sequence numbers of the messages that contain a term,
+    stored as the first sequence number followed by varint-encoded deltas.
+    """
+
+    __slots__ = (
+        "count",
+        "data",
+        "first",
+        "last",
+    )
+
+    def __init__(self, seq: int) -> None:
+        self.first = seq
+        self.last = seq
+        self.count = 1
+        self.data = bytearray()
+
+    def __iter__(self) -> Iterator[int]:
+        seq = self.first
+        yield seq
+
+        delta, shift = 0, 0
+        for byte in self.data:
+            delta |= (byte & 0x7F) << shift
+            if byte & 0x80:
+                shift += 7
+                continue
+
+            seq += delta
+            yield seq
+            delta, shift = 0, 0
+
+    def append(self, seq: int) -> None:
+        """
+        Appends the given sequence number, which must be greater than every number in the list.
+        """
+        delta = seq - self.last
+        while delta > 0x7F:
+            self.data.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        self.data.append(delta)
+        self.last = seq
+        self.count += 1
+
+    def pop_first(self) -> None:
+        """
+        Removes the first sequence number. The list must contain at least two numbers.
+        """
+        data = self.data
+        delta, shift, i = 0, 0, 0
+        while True:
+            byte = data[i]
+            delta |= (byte & 0x7F) << shift
+            i += 1
+            if not byte & 0x80:
+                break
+            shift += 7
+
+        del data[:i]  # Deleting from the start of a bytearray doesn't move the rest of the data.
+        self.first += delta
+        self.count -= 1
+
+
+class RoomMessageIndex:
+    """
+    Bounded message history of a room with an incrementally maintained inverted index.
+
+    When the history is full, the oldest message and its postings are evicted.
+    """
+
+    __slots__ = (
+        "_max_messages",
+        "_messages",
+        "_next_seq",
+        "_postings",
+    )
+
+    def __init__(self, *, max_messages: int = 10_000) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            max_messages: The maximum number of messages the index retains.
+        """
+        self._max_messages = max_messages
+        self._messages: dict[int, IndexedMessage] = {}  # In insertion (and therefore sequence) order.
+        self._next_seq = 1
+        self._postings: dict[str, _Postings] = {}
+
+    def __len__(self) -> int:
+        """
+        The number of retained messages.
+        """
+        return len(self._messages)
+
+    def add(self, text: str, *, user_name: str, user_email: str) -> IndexedMessage:
+        """
+        Adds the given message to the history and the index.
+
+        Arguments:
+            text: The message text.
+            user_name: The name of the sender.
+            user_email: The email address of the sender.
+        """
+        seq = self._next_seq
+        self._next_seq += 1
+
+        message = IndexedMessage(
+            seq=seq, created_at=time.time(), user_name=user_name, user_email=user_email, text=text
+        )
+        self._messages[seq] = message
+
+        postings = self._postings
+        for term in tokenize(text):
+            term_postings = postings.get(term, None)
+            if term_postings is None:
+                postings[term] = _Postings(seq)
+            else:
+                term_postings.append(seq)
+
+        if len(self._messages) > self._max_messages:
+            self._evict_oldest()
+
+        return message
+
+    def snapshot(self) -> tuple[Any, ...]:
+        """
+        Returns the state of the index as a tuple of built-in types, see `restore()`.
+        """
+        return (
+            self._next_seq,
+            [tuple(message) for message in self._messages.values()],
+            {term: (p.first, p.last, p.count, bytes(p.data)) for term, p in self._postings.items()},
+        )
+
+    def restore(self, state: tuple[Any, ...]) -> None:
+        """
+        Replaces the content of the index with the given state, that was created by `snapshot()`.
+
+        Arguments:
+            state: The state to restore.
+        """
+        next_seq, messages, postings = state
+        restored_postings: dict[str, _Postings] = {}
+        for term, (first, last, count, data) in postings.items():
+            term_postings = restored_postings[term] = _Postings(first)
+            term_postings.last = last
+            term_postings.count = count
+            term_postings.data = bytearray(data)
+
+        self._next_seq = next_seq
+        self._messages = {message[0]: IndexedMessage(*message) for message in messages}
+        self._postings = restored_postings
+        while len(self._messages) > self._max_messages:
+            self._evict_oldest()
+
+    def search(self, query: str, *, after: SearchCursor | None = None, limit: int = 20) -> SearchPage:
+        """
+        Returns the messages that contain any of the terms of the given query, ranked by the sum
+        of the inverse document frequencies of the matching terms, most recent first among equals.
+
+        Arguments:
+            query: The search query.
+            after: The cursor of the previous page of the same query.
+            limit: The maximum number of hits to return.
+
+        Raises:
+            ValueError: If the cursor doesn't belong to the query.
+        """
+        terms = sorted(tokenize(query))
+        postings = self._postings
+        if after is None:
+            max_seq = self._next_seq - 1
+            message_count = len(self._messages)
+            weights = tuple(
+                0.0
+                if (term_postings := postings.get(term, None)) is None
+                else math.log(1 + message_count / term_postings.count)
+                for term in terms
+            )
+        elif len(after.weights) != len(terms):
+            raise ValueError("The cursor belongs to another query.")
+        else:
+            max_seq, weights = after.max_seq, after.weights
+
+        scores: dict[int, float] = {}
+        for term, weight in zip(terms, weights):
+            term_postings = postings.get(term, None)
+            if term_postings is None:
+                continue
+
+            for seq in term_postings:
+                if seq > max_seq:  # Posting lists are ascending.
+                    break
+                scores[seq] = scores.get(seq, 0.0) + weight
+
+        # Hits are ordered by (-score, -seq), the cursor is the key of the last hit of the previous page.
+        keys = ((-score, -seq) for seq, score in scores.items())
+        if after is not None:
+            cursor = (-after.score, -after.seq)
+            keys = (key for key in keys if key > cursor)
+
+        messages = self._messages
+        hits = [
+            SearchHit(score=-neg_score, message=messages[-neg_seq]) for neg_score, neg_seq in nsmallest(limit, keys)
+        ]
+        return SearchPage(
+            hits=hits,
+            cursor=(
+                SearchCursor(max_seq=max_seq, weights=weights, score=hits[-1].score, seq=hits[-1].message.seq)
+                if len(hits) == limit
+                else None
+            ),
+        )
+
+    def _evict_oldest(self) -> None:
+        """
+        Removes the oldest message from the history and its sequence number from the postings.
+        """
+        messages, postings = self._messages, self._postings
+        seq = next(iter(messages))
+        message = messages.pop(seq)
+        for term in tokenize(message.text):
+            # The evicted message is the oldest one, so it's at the start of every posting list it's in.
+            term_postings = postings[term]
+            if term_postings.count == 1:
+                del postings[term]
+            else:
+                term_postings.pop_first()
+
+
+class MessageIndex:
+    """
+    Message indexes of all rooms.
+
+    The number of indexed rooms is bounded, the index of the least recently active room is dropped
+    when the limit is reached.
+
+    Restored room indexes are only rebuilt from their snapshot state when the room is first used.
+    """
+
+    __slots__ = (
+        "_max_messages_per_room",
+        "_max_rooms",
+        "_rooms",
+    )
+
+    def __init__(self, *, max_rooms: int = 1024, max_messages_per_room: int = 10_000) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            max_rooms: The maximum number of indexed rooms.
+            max_messages_per_room: The maximum number of messages retained per room.
+        """
+        self._max_rooms = max_rooms
+        self._max_messages_per_room = max_messages_per_room
+        # Room indexes, or their snapshot state if they haven't been used since they were restored.
+        self._rooms: OrderedDict[str, RoomMessageIndex | tuple[Any, ...]] = OrderedDict()
+
+    def add(self, room: str, text: str, *, user_name: str, user_email: str) -> IndexedMessage:
+        """
+        Adds the given message to the index of the given room.
+
+        Arguments:
+            room: The room the message was sent to.
+            text: The message text.
+            user_name: The name of the sender.
+            user_email: The email address of the sender.
+        """
+        rooms = self._rooms
+        index = self._get_room_index(room)
+        if index is None:
+            index = rooms[room] = RoomMessageIndex(max_messages=self._max_messages_per_room)
+            if len(rooms) > self._max_rooms:
+                rooms.popitem(last=False)
+        else:
+            rooms.move_to_end(room)
+
+        return index.add(text, user_name=user_name, user_email=user_email)
+
+    def snapshot(self) -> list[tuple[str, tuple[Any, ...]]]:
+        """
+        Returns the state of every room index from the least to the most recently active room, see `restore()`.
+        """
+        return [item for chunk in self.iter_snapshot() for item in chunk]
+
+    def iter_snapshot(self, *, chunk_size: int = 1000) -> Iterator[list[tuple[str, tuple[Any, ...]]]]:
+        """
+        Returns the result of `snapshot()` in chunks, so the caller can take a snapshot without blocking
+        the event loop for long.
+
+        The set of rooms is fixed when the iteration starts, the state of every room is copied when
+        its chunk is created.
+
+        Arguments:
+            chunk_size: The maximum number of rooms in a chunk.
+        """
+        items = list(self._rooms.items())
+        for start in range(0, len(items), chunk_size):
+            yield [
+                (room, index if isinstance(index, tuple) else index.snapshot())
+                for room, index in items[start : start + chunk_size]
+            ]
+
+    def restore(self, state: list[tuple[str, tuple[Any, ...]]]) -> None:
+        """
+        Replaces the content of the index with the given state, that was created by `snapshot()`.
+
+        Arguments:
+            state: The state to restore.
+        """
+        self._rooms = OrderedDict(state[-self._max_rooms :])
+
+    def search(self, room: str, query: str, *, after: SearchCursor | None = None, limit: int = 20) -> SearchPage:
+        """
+        Searches the messages of the given room, see `RoomMessageIndex.search()`.
+
+        Arguments:
+            room: The room to search in.
+            query: The search query.
+            after: The cursor of the previous page of the same query.
+            limit: The maximum number of hits to return.
+
+        Raises:
+            ValueError: If the cursor doesn't belong to the query.
+        """
+        index = self._get_room_index(room)
+        return SearchPage(hits=[], cursor=None) if index is None else index.search(query, after=after, limit=limit)
+
+    def _get_room_index(self, room: str) -> RoomMessageIndex | None:
+        """
+        Returns the index of the given room, rebuilding it first if it's only restored from a snapshot.
+        """
+        index = self._rooms.get(room, None)
+        if isinstance(index, tuple):
+            state, index = index, RoomMessageIndex(max_messages=self._max_messages_per_room)
+            index.restore(state)
+            self._rooms[room] = index
+
+        return index
@@ -0,0 +1,393 @@
+from __future__ import annotations
+from typing import Any, Awaitable, Callable, Iterable, NamedTuple, Protocol, Sequence, TypeVar, Union
+
+import asyncio
+from concurrent.futures import BrokenExecutor, Executor, Future, ProcessPoolExecutor
+from functools import partial
+import logging
+import re
+
+_logger = logging.getLogger(__name__)
+
+_T = TypeVar("_T")
+
+
+class PipelineMessage(NamedTuple):
+    """
+    An incoming chat message as it passes through the message pipeline.
+    """
+
+    room: str
+    user_email: str
+    text: str
+    mentions: tuple[str, ...] = ()
+    """
+    The email addresses of the users the message mentions.
+    """
+
+
+MessageFilter = Callable[[PipelineMessage], Union[PipelineMessage, None]]
+"""
+Synchronous pipeline stage that returns the transformed message, or `None` if the message must be dropped.
+
+Filters that run on a process pool must be picklable, e.g. module-level functions or `functools.partial`
+objects that wrap them.
+"""
+
+
+class AsyncMessageFilter(Protocol):
+    """
+    Asynchronous pipeline stage that runs on the event loop.
+    """
+
+    async def __call__(self, message: PipelineMessage, /) -> PipelineMessage | None:
+        """
+        Returns the transformed message, or `None` if the message must be dropped.
+
+        Arguments:
+            message: The message to process.
+        """
+        ...
+
+
+class Inline(NamedTuple):
+    """
+    Marks a cheap filter that runs directly on the event loop.
+    """
+
+    filter: MessageFilter
+
+
+class Offloaded(NamedTuple):
+    """
+    Marks a CPU-heavy filter that must run on the worker pool of the pipeline instead of the event loop.
+    """
+
+    filter: MessageFilter
+
+
+PipelineStage = Union[AsyncMessageFilter, Inline, Offloaded]
+
+
+def run_filters(
+    filters: tuple[MessageFilter, ...], messages: list[PipelineMessage]
+) -> list[PipelineMessage | Exception | None]:
+    """
+    Runs the given filters on each of the given messages. This is the job the worker pool executes.
+
+    Arguments:
+        filters: The filters to run, in order.
+        messages: The messages to process.
+
+    Returns:
+        The processed messages in the order of `messages`, `None` in place of the dropped ones,
+        and the raised exception in place of the ones a filter failed on.
+    """
+    result: list[PipelineMessage | Exception | None] = []
+    for message in messages:
+        processed: PipelineMessage | None = message
+        try:
+            for message_filter in filters:
+                processed = message_filter(processed)  # type: ignore[arg-type]
+                if processed is None:
+                    break
+        except Exception as e:
+            # Only fail this message, the rest of the batch comes from other senders.
+            result.append(e)
+            continue
+
+        result.append(processed)
+
+    return result
+
+
+class RestartingProcessPool(Executor):
+    """
+    Process pool that replaces its worker processes after the pool broke, e.g. because a worker was killed.
+
+    The jobs that were running when the pool broke fail with `BrokenExecutor`, the next job starts a new pool.
+    """
+
+    def __init__(self, max_workers: int | None = None) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            max_workers: The number of worker processes, the number of CPUs if `None`.
+        """
+        self._max_workers = max_workers
+        self._pool = ProcessPoolExecutor(max_workers)
+
+    def submit(self, fn: Callable[..., _T], /, *args: Any, **kwargs: Any) -> Future[_T]:
+        """
+        Inherited.
+        """
+        pool = self._pool
+        try:
+            return pool.submit(fn, *args, **kwargs)
+        except BrokenExecutor:
+            if self._pool is pool:
+                _logger.warning("The process pool broke, starting new worker processes.")
+                pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = ProcessPoolExecutor(self._max_workers)
+
+            return self._pool.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        """
+        Inherited.
+        """
+        self._pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+
+class _Batcher:
+    """
+    Collects the messages that reach a group of consecutive offloaded filters and submits them
+    to the worker pool in batches.
+
+    A batch is submitted when it's full or when the event loop finished its current iteration,
+    so messages are never delayed waiting for a batch to fill up.
+    """
+
+    __slots__ = (
+        "_batch_size",
+        "_executor",
+        "_filters",
+        "_pending",
+        "_semaphore",
+        "_tasks",
+    )
+
+    def __init__(
+        self,
+        filters: tuple[MessageFilter, ...],
+        *,
+        executor: Executor | None,
+        semaphore: asyncio.Semaphore,
+        batch_size: int,
+    ) -> None:
+        self._filters = filters
+        self._executor = executor
+        self._semaphore = semaphore
+        self._batch_size = batch_size
+        self._pending: list[tuple[PipelineMessage, asyncio.Future[PipelineMessage | None]]] = []
+        self._tasks: set[asyncio.Task] = set()
+
+    def submit(self, message: PipelineMessage) -> asyncio.Future[PipelineMessage | None]:
+        """
+        Adds the given message to the current batch and returns the future of its result.
+        """
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[PipelineMessage | None] = loop.create_future()
+        pending = self._pending
+        pending.append((message, future))
+        if len(pending) >= self._batch_size:
+            self._flush()
+        elif len(pending) == 1:
+            loop.call_soon(self._flush)
+
+        return future
+
+    def _flush(self) -> None:
+        """
+        Submits the current batch to the worker pool.
+        """
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[PipelineMessage, asyncio.Future[PipelineMessage | None]]]) -> None:
+        """
+        Runs the filters on the given batch in the worker pool and resolves the futures of the batch.
+        """
+        try:
+            async with self._semaphore:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, run_filters, self._filters, [message for message, _ in batch]
+                )
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class MessagePipeline:
+    """
+    Ordered, pluggable filter and transform pipeline for incoming chat messages.
+
+    Async and inline stages run on the event loop. Consecutive offloaded stages are grouped, and the
+    messages that reach a group are processed in batches on the worker pool, with a bounded number
+    of batches in flight, so CPU-heavy filters don't block the event loop.
+
+    Messages of the same room are returned in the order they entered the pipeline, even if a later
+    message finishes processing first.
+
+    If a stage raises, the error is logged and the message is dropped, so a failing filter doesn't
+    disconnect the sender, and the message is never delivered without the filters that failed.
+    """
+
+    __slots__ = (
+        "_stages",
+        "_tails",
+    )
+
+    def __init__(
+        self,
+        stages: Sequence[PipelineStage] = (),
+        *,
+        executor: Executor | None = None,
+        max_concurrency: int = 4,
+        batch_size: int = 64,
+    ) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            stages: The stages of the pipeline, in order.
+            executor: The worker pool of offloaded stages, the default executor of the event loop if `None`.
+                The pipeline doesn't shut it down.
+            max_concurrency: The maximum number of batches the worker pool may process at the same time.
+            batch_size: The maximum number of messages in a batch.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        self._stages: list[Callable[[PipelineMessage], Awaitable[PipelineMessage | None]]] = []
+        offloaded: list[MessageFilter] = []
+        for stage in (*stages, None):
+            if isinstance(stage, Offloaded):
+                offloaded.append(stage.filter)
+                continue
+
+            if offloaded:
+                batcher = _Batcher(tuple(offloaded), executor=executor, semaphore=semaphore, batch_size=batch_size)
+                self._stages.append(batcher.submit)
+                offloaded = []
+
+            if isinstance(stage, Inline):
+                self._stages.append(_make_async(stage.filter))
+            elif stage is not None:
+                self._stages.append(stage)
+
+        # The completion future of the last message that entered the pipeline, by room.
+        self._tails: dict[str, asyncio.Future[None]] = {}
+
+    async def process(self, message: PipelineMessage) -> PipelineMessage | None:
+        """
+        Runs the given message through the pipeline.
+
+        Arguments:
+            message: The message to process.
+
+        Returns:
+            The processed message, or `None` if one of the stages dropped it or failed.
+        """
+        if not self._stages:
+            return message
+
+        room, tails = message.room, self._tails
+        previous = tails.get(room, None)
+        done: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        tails[room] = done
+        try:
+            result: PipelineMessage | None = message
+            try:
+                for stage in self._stages:
+                    result = await stage(result)
+                    if result is None:
+                        break
+            except Exception:
+                _logger.exception("Message pipeline failed, dropping a message in room %s.", room)
+                result = None
+
+            if previous is not None and not previous.done():
+                # Wait for the earlier messages of the room without cancelling them if this task is cancelled.
+                await asyncio.wait((previous,))
+
+            return result
+        finally:
+            done.set_result(None)
+            if tails.get(room, None) is done:
+                del tails[room]
+
+
+def _make_async(message_filter: MessageFilter) -> Callable[[PipelineMessage], Awaitable[PipelineMessage | None]]:
+    """
+    Returns an async stage that runs the given filter on the event loop.
+    """
+
+    async def stage(message: PipelineMessage) -> PipelineMessage | None:
+        return message_filter(message)
+
+    return stage
+
+
+def normalize_length(message: PipelineMessage, *, max_length: int) -> PipelineMessage | None:
+    """
+    Message filter that strips the surrounding whitespace of the message, drops empty messages,
+    and truncates messages that are longer than `max_length` characters.
+    """
+    text = message.text.strip()
+    if not text:
+        return None
+
+    if len(text) > max_length:
+        text = f"{text[:max_length - 1].rstrip()}…"
+
+    return message if text == message.text else message._replace(text=text)
+
+
+def mask_words(message: PipelineMessage, *, pattern: re.Pattern[str]) -> PipelineMessage:
+    """
+    Message filter that replaces every match of the given pattern with asterisks.
+    """
+    text = pattern.sub(lambda m: "*" * len(m.group()), message.text)
+    return message if text == message.text else message._replace(text=text)
+
+
+def make_word_filter(words: Iterable[str]) -> MessageFilter:
+    """
+    Creates a (picklable) message filter that masks the given words, ignoring case.
+
+    Arguments:
+        words: The words to mask.
+    """
+    alternatives = "|".join(re.escape(word) for word in sorted(set(words), key=len, reverse=True) if word)
+    return partial(mask_words, pattern=re.compile(rf"\b(?:{alternatives})\b" if alternatives else r"(?!)", re.I))
+
+
+_link_pattern = re.compile(r"\b(?:https?://|www\.)\S+", re.I)
+
+
+def mask_links(message: PipelineMessage) -> PipelineMessage:
+    """
+    Message filter that replaces links with `[link]`.
+    """
+    text = _link_pattern.sub("[link]", message.text)
+    return message if text == message.text else message._replace(text=text)
+
+
+_mention_pattern = re.compile(r"(?<![\w@])@([\w.+-]+@[\w-]+(?:\.[\w-]+)+)")
+
+
+def extract_mentions(message: PipelineMessage) -> PipelineMessage:
+    """
+    Message filter that collects the `@<email>` mentions of the message.
+    """
+    mentions = tuple(dict.fromkeys(email.lower() for email in _mention_pattern.findall(message.text)))
+    return message._replace(mentions=mentions) if mentions else message
@@ -59,6 +59,7 @@ def chat_script(*, chat_ws_url: str) -> script:
                 f"    if (!(('email' in payload.user) && (typeof payload.user.email === 'string'))) return undefined;",
                 f"    if (!(('self' in payload.user) && (typeof payload.user.self === 'boolean'))) return undefined;",
                 f"    if (!(('message' in payload) && (typeof payload.message === 'string'))) return undefined;",
+                f"    if (('room' in payload) && (typeof payload.room !== 'string')) return undefined;",
                 f"",
                 f"    return {{",
                 f"        user: {{",
@@ -67,16 +68,29 @@ def chat_script(*, chat_ws_url: str) -> script:
                 f"            self: payload.user.self,",
                 f"        }},",
                 f"        message: payload.message,",
+                f"        direct: payload.direct === true,",
+                f"        room: payload.room,",
                 f"    }};",
                 f"}}",
                 f"",
                 f"function makeMessageNode(message) {{",
                 f"    const li = document.createElement('li');",
                 f"    li.classList.add('list-group-item');",
-                f"    li.classList.add(message.user.self ? 'list-group-item-primary' : 'list-group-item-info');",
+                f"    if (message.direct) {{",
+                f"        li.classList.add(message.user.self ? 'list-group-item-secondary' : 'list-group-item-warning');",
+                f"    }} else {{",
+                f"        li.classList.add(message.user.self ? 'list-group-item-primary' : 'list-group-item-info');",
+                f"    }}",
                 f"",
                 f"    const userInfo = document.createElement('h6');",
                 f"    userInfo.appendChild(document.createTextNode(`${{message.user.name}} (${{message.user.email}})`));",
+                f"    if (message.direct) {{",
+                f"        const directInfo = document.createElement('small');",
+                f"        directInfo.classList.add('ml-2', 'text-muted');",
+                f"        const source = message.room === undefined ? '' : ` from room ${{message.room}}`;",
+                f"        directInfo.appendChild(document.createTextNode(`Direct message${{source}}`));",
+                f"        userInfo.appendChild(directInfo);",
+                f"    }}",
                 f"",
                 f"    const paragraph = document.createElement('p');",
                 f"    paragraph.classList.add('m-0');",
@@ -88,10 +102,24 @@ def chat_script(*, chat_ws_url: str) -> script:
                 f"    return li;",
                 f"}}",
                 f"",
+                f"function parseReconnectDelay(message) {{",
+                f"    const payload = JSON.parse(message);",
+                f"    if (!('reconnect' in payload)) return undefined;",
+                f"    if (!(('delay' in payload.reconnect) && (typeof payload.reconnect.delay === 'number'))) return undefined;",
+                f"",
+                f"    return payload.reconnect.delay;",
+                f"}}",
+                f"",
                 f"function connectToChat() {{",
-                f"    const ws = new WebSocket(`{chat_ws_url}`);",
+                f"    const socket = new WebSocket(`{chat_ws_url}`);",
                 "",
-                f"    ws.onmessage = (event) => {{",
+                f"    socket.onmessage = (event) => {{",
+                f"        const reconnectDelay = parseReconnectDelay(event.data);",
+                f"        if (reconnectDelay !== undefined) {{",
+                f"            setTimeout(() => {{ ws = connectToChat(); }}, reconnectDelay * 1000);",
+                f"            return;",
+                f"        }}",
+                f"",
                 f"        const message = parseMessage(event.data);",
                 f"        if (!message) return;",
                 f"",
@@ -104,7 +132,7 @@ def chat_script(*, chat_ws_url: str) -> script:
                 f"        }}",
                 f"    }};",
                 f"",
-                f"    return ws;",
+                f"    return socket;",
                 f"}}",
                 "",
                 f"function sendMessage(event) {{",
@@ -123,7 +151,7 @@ def chat_script(*, chat_ws_url: str) -> script:
 def chat_and_connect_scripts(*, chat_ws_url: str) -> tuple[script, script]:
     return (
         chat_script(chat_ws_url=chat_ws_url),
-        script("const ws = connectToChat();"),
+        script("let ws = connectToChat();"),
     )
 
 
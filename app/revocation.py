@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import asyncio
+from functools import lru_cache
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from .settings import get_settings
+
+_logger = logging.getLogger(__name__)
+
+
+class RevocationStore:
+    """
+    Denylist of revoked token IDs, shared by the worker processes through an append-only file.
+
+    Lookups only touch an in-memory hash table. A background task started by `start()` checks the
+    file for revocations appended by other processes every `sync_interval` seconds in a worker thread,
+    and only the new part of the file is read.
+
+    Every entry expires together with its token. Expired entries are periodically dropped from memory,
+    and the file is compacted when most of its entries expired.
+
+    The methods that touch the file block, call them from a worker thread on the event loop. They
+    are serialized by a lock, so the event loop only ever reads the hash table.
+    """
+
+    __slots__ = (
+        "_file_entries",
+        "_inode",
+        "_lock",
+        "_next_purge",
+        "_offset",
+        "_path",
+        "_purge_interval",
+        "_revoked",
+        "_sync_interval",
+        "_task",
+    )
+
+    def __init__(self, path: str, *, sync_interval: float = 1, purge_interval: float = 300) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            path: The path of the revocation file.
+            sync_interval: The maximum number of seconds it takes for a revocation to reach every process.
+            purge_interval: The number of seconds between two scans for expired entries.
+        """
+        self._path = path
+        self._sync_interval = sync_interval
+        self._purge_interval = purge_interval
+        self._revoked: dict[str, float] = {}  # Token ID -> expiry.
+        self._inode: int | None = None
+        self._offset = 0
+        self._file_entries = 0
+        self._next_purge = time.monotonic() + purge_interval
+        self._lock = threading.RLock()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        """
+        The number of revoked tokens, including the expired ones that haven't been dropped yet.
+        """
+        return len(self._revoked)
+
+    def is_revoked(self, token_id: str) -> bool:
+        """
+        Returns whether the token with the given ID is revoked.
+
+        Arguments:
+            token_id: The ID of the token.
+        """
+        return token_id in self._revoked
+
+    def revoke(self, token_id: str, expires_at: float) -> None:
+        """
+        Revokes the token with the given ID.
+
+        Blocking, run it in a worker thread.
+
+        Arguments:
+            token_id: The ID of the token.
+            expires_at: The expiry of the token as a UNIX timestamp, the entry can be forgotten after it.
+        """
+        with self._lock:
+            self._revoked[token_id] = expires_at
+            with self._file_lock():
+                with open(self._path, "a") as f:
+                    f.write(f"{token_id} {expires_at}\n")
+
+                # The entry count is updated when the file is synced.
+                if self._file_entries > 1024 and self._file_entries > 2 * len(self._revoked):
+                    self._compact()
+
+    def sync(self) -> None:
+        """
+        Loads the revocations other processes appended to the file, and drops the expired entries if it's time.
+
+        Blocking, run it in a worker thread.
+        """
+        with self._lock:
+            monotonic_now = time.monotonic()
+            now = time.time()
+            if monotonic_now >= self._next_purge:
+                self._next_purge = monotonic_now + self._purge_interval
+                revoked = self._revoked
+                for token_id in [token_id for token_id, expires_at in revoked.items() if expires_at <= now]:
+                    del revoked[token_id]
+
+            try:
+                stat = os.stat(self._path)
+            except FileNotFoundError:
+                return
+
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                # The file was compacted (or replaced), read it from the start.
+                self._inode = stat.st_ino
+                self._offset = 0
+                self._file_entries = 0
+
+            if stat.st_size > self._offset:
+                self._read(now)
+
+    async def start(self) -> None:
+        """
+        Loads the revocation file and starts syncing it in the background.
+        """
+        if self._task is None:
+            await asyncio.to_thread(self.sync)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops syncing the revocation file.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        """
+        Task that syncs the revocation file every `sync_interval` seconds.
+        """
+        while True:
+            await asyncio.sleep(self._sync_interval)
+            try:
+                await asyncio.to_thread(self.sync)
+            except Exception:
+                _logger.exception("Failed to sync revocation file %s.", self._path)
+
+    def _read(self, now: float) -> None:
+        """
+        Reads the complete lines of the revocation file from the current offset.
+        """
+        with open(self._path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+
+        end = data.rfind(b"\n") + 1  # Skip the incomplete last line that is being written.
+        self._offset += end
+
+        lines = data[:end].decode().splitlines()
+        self._file_entries += len(lines)
+
+        revoked = self._revoked
+        for line in lines:
+            token_id, _, expires_at_str = line.partition(" ")
+            expires_at = float(expires_at_str)
+            if expires_at > now:
+                revoked[token_id] = expires_at
+
+    def _compact(self) -> None:
+        """
+        Rewrites the revocation file with only the live entries. Must be called with the locks held.
+        """
+        self.sync()  # Load everything other processes wrote, so nothing is lost.
+
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(f"{token_id} {expires_at}\n" for token_id, expires_at in self._revoked.items())
+        os.replace(tmp_path, self._path)
+
+        stat = os.stat(self._path)
+        self._inode = stat.st_ino
+        self._offset = stat.st_size
+        self._file_entries = len(self._revoked)
+
+    def _file_lock(self) -> _FileLock:
+        """
+        Returns a lock that serializes the file modifications of all processes.
+        """
+        return _FileLock(f"{self._path}.lock")
+
+
+class _FileLock:
+    """
+    Exclusive inter-process lock based on `flock()`.
+    """
+
+    __slots__ = ("_fd", "_path")
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._fd = -1
+
+    def __enter__(self) -> None:
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *_: object) -> None:
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+
+
+@lru_cache(maxsize=1)
+def get_revocation_store() -> RevocationStore:
+    """
+    Returns the (cached) revocation store of the application.
+
+    FastAPI dependency.
+    """
+    return RevocationStore(get_settings().revocation_file)
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+from bisect import bisect_left, bisect_right, insort
+from heapq import heapify, heappop, heappush
+
+
+class RoomDirectory:
+    """
+    Incrementally maintained directory of the active rooms and their occupancy.
+
+    Rooms are kept in a sorted list for prefix search and pagination, and in a heap with lazy
+    deletion for listing the busiest rooms. Queries cost O(log n + k) (plus the amortized cost of
+    discarding outdated heap entries), independently of the total number of rooms.
+    """
+
+    __slots__ = (
+        "_heap",
+        "_names",
+        "_occupancy",
+    )
+
+    def __init__(self) -> None:
+        """
+        Initialization.
+        """
+        self._heap: list[tuple[int, str]] = []  # (-occupancy, room) pairs, may contain outdated entries.
+        self._names: list[str] = []  # Sorted room names.
+        self._occupancy: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        """
+        The number of rooms in the directory.
+        """
+        return len(self._occupancy)
+
+    def get_occupancy(self, room: str) -> int:
+        """
+        Returns the occupancy of the given room, 0 if the room is not in the directory.
+
+        Arguments:
+            room: The name of the room.
+        """
+        return self._occupancy.get(room, 0)
+
+    def update(self, room: str, occupancy: int) -> None:
+        """
+        Sets the occupancy of the given room, removing the room if it's empty.
+
+        Arguments:
+            room: The name of the room.
+            occupancy: The number of connections in the room.
+        """
+        if occupancy <= 0:
+            self.remove(room)
+            return
+
+        current = self._occupancy.get(room, None)
+        if current == occupancy:
+            return
+
+        if current is None:
+            insort(self._names, room)
+
+        self._occupancy[room] = occupancy
+        heappush(self._heap, (-occupancy, room))
+
+        if len(self._heap) > 2 * len(self._occupancy) + 64:
+            self._rebuild_heap()
+
+    def remove(self, room: str) -> None:
+        """
+        Removes the given room from the directory.
+
+        Arguments:
+            room: The name of the room.
+        """
+        if self._occupancy.pop(room, None) is None:
+            return
+
+        names = self._names
+        del names[bisect_left(names, room)]
+        # Heap entries of the room become outdated and are discarded lazily.
+
+    def snapshot(self) -> list[tuple[str, int]]:
+        """
+        Returns every room with its occupancy, see `restore()`.
+        """
+        return list(self._occupancy.items())
+
+    def restore(self, state: list[tuple[str, int]]) -> None:
+        """
+        Replaces the content of the directory with the given rooms.
+
+        Arguments:
+            state: The rooms with their occupancy, as returned by `snapshot()`.
+        """
+        self._occupancy = {room: occupancy for room, occupancy in state if occupancy > 0}
+        self._names = sorted(self._occupancy)
+        self._rebuild_heap()
+
+    def top(self, k: int) -> list[tuple[str, int]]:
+        """
+        Returns the `k` busiest rooms with their occupancy, in decreasing order of occupancy.
+
+        Arguments:
+            k: The maximum number of rooms to return.
+        """
+        heap, occupancy = self._heap, self._occupancy
+        result: list[tuple[str, int]] = []
+        valid: list[tuple[int, str]] = []
+        while heap and len(result) < k:
+            entry = heappop(heap)
+            neg_occupancy, room = entry
+            if occupancy.get(room, None) != -neg_occupancy or (valid and valid[-1] == entry):
+                continue  # Outdated or duplicate entry, drop it for good.
+
+            valid.append(entry)
+            result.append((room, -neg_occupancy))
+
+        for entry in valid:
+            heappush(heap, entry)
+
+        return result
+
+    def search(self, prefix: str = "", *, after: str | None = None, limit: int = 50) -> list[tuple[str, int]]:
+        """
+        Returns the rooms whose name starts with the given prefix, with their occupancy, in alphabetical order.
+
+        Arguments:
+            prefix: The prefix room names must start with.
+            after: Pagination cursor, only rooms that come after this name are returned.
+            limit: The maximum number of rooms to return.
+        """
+        names, occupancy = self._names, self._occupancy
+        start = bisect_left(names, prefix)
+        if after is not None:
+            start = max(start, bisect_right(names, after))
+
+        result: list[tuple[str, int]] = []
+        for i in range(start, min(start + limit, len(names))):
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            result.append((name, occupancy[name]))
+
+        return result
+
+    def _rebuild_heap(self) -> None:
+        """
+        Rebuilds the heap from the current occupancy values, dropping the outdated entries.
+        """
+        self._heap = [(-occupancy, room) for room, occupancy in self._occupancy.items()]
+        heapify(self._heap)
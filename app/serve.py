@@ -0,0 +1,246 @@
+"""
+Production entry point.
+
+Usage: `python -m app.serve --workers 4 --port 8000`
+
+Workers don't share chat state. With `--workers N`, the kernel hands every new connection to any
+of the workers, and every worker has its own chat rooms, room directory and room history:
+
+- members of the same room only see each other's messages if they are connected to the same worker,
+- `/dm` only reaches the recipients' connections on the sender's worker,
+- the room directory and room search only cover the rooms and messages of the serving worker,
+- every worker snapshots its own state, and after a restart clients rejoin random workers.
+
+Run more than one worker only if every room can tolerate this, e.g. behind a load balancer that
+routes by room.
+"""
+from __future__ import annotations
+from typing import Any
+
+from argparse import ArgumentParser
+from importlib.util import find_spec
+import logging
+import multiprocessing
+import random
+import signal
+import socket
+
+import uvicorn
+
+from .app import create_app
+from .chat_api import make_reconnect_message
+from .connection_manager import ConnectionManagerRegistry
+from .jwt import get_jwt_decoder, get_jwt_encoder
+from .settings import get_settings
+from .snapshot import StateSnapshotter
+
+_logger = logging.getLogger(__name__)
+
+
+class DrainingServer(uvicorn.Server):
+    """
+    Uvicorn server that drains the chat rooms when it shuts down.
+
+    After the server stops accepting connections, the last snapshot of the chat state is taken (if
+    the application has a snapshotter), every chat client receives a reconnect message with a random
+    delay, so clients don't rejoin (another worker or the next deployment) all at once, and then the
+    chat rooms are closed.
+    """
+
+    def __init__(
+        self,
+        config: uvicorn.Config,
+        *,
+        connection_manager_registry: ConnectionManagerRegistry,
+        reconnect_delay: float,
+        reconnect_jitter: float,
+        snapshotter: StateSnapshotter | None = None,
+    ) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            config: The server configuration.
+            connection_manager_registry: The registry whose connection managers must be closed on shutdown.
+            reconnect_delay: The minimum number of seconds clients should wait before reconnecting.
+            reconnect_jitter: The maximum number of seconds that is randomly added to `reconnect_delay`.
+            snapshotter: The snapshotter of the application's chat state.
+        """
+        super().__init__(config)
+        self._connection_manager_registry = connection_manager_registry
+        self._snapshotter = snapshotter
+        self._reconnect_delay = reconnect_delay
+        self._reconnect_jitter = reconnect_jitter
+
+    async def shutdown(self, sockets: list[socket.socket] | None = None) -> None:
+        # Stop accepting new connections.
+        for server in self.servers:
+            server.close()
+        for sock in sockets or []:
+            sock.close()
+
+        if self._snapshotter is not None:
+            # Closing the chat rooms resets their occupancy, save the state while it's intact.
+            self._snapshotter.seal()
+
+        await self._connection_manager_registry.close(
+            code=1012,  # Service restart.
+            make_farewell_message=lambda: make_reconnect_message(
+                round(self._reconnect_delay + random.uniform(0, self._reconnect_jitter), 3)
+            ),
+        )
+
+        await super().shutdown(sockets=sockets)
+
+
+def prewarm() -> None:
+    """
+    Loads the settings and exercises the JWT codec, so the first requests don't pay for it.
+    """
+    settings = get_settings()
+    get_jwt_decoder(settings)(get_jwt_encoder(settings)({}))
+
+
+def bind_socket(*, host: str, port: int, reuse_port: bool) -> socket.socket:
+    """
+    Creates the listening socket of a worker.
+
+    Arguments:
+        host: The host to bind to.
+        port: The port to bind to.
+        reuse_port: Whether to set `SO_REUSEPORT`, so every worker can bind its own socket to the same port
+            and the kernel balances connections between them.
+    """
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(
+    *,
+    host: str,
+    port: int,
+    reuse_port: bool,
+    reconnect_delay: float,
+    reconnect_jitter: float,
+    ws_max_size: int,
+    ws_max_queue: int,
+    ws_per_message_deflate: bool,
+    snapshot_file: str | None = None,
+    trace_file: str | None = None,
+) -> None:
+    """
+    Creates and prewarms the application, and serves it until the process receives SIGINT or SIGTERM.
+
+    The websocket limits determine most of the memory an idle connection costs: the maximum
+    message size bounds the read buffer, the queue size bounds the number of buffered incoming
+    messages, and per-message deflate allocates compression contexts for every connection.
+
+    Every worker has its own chat state, so every worker needs its own `snapshot_file`, and
+    every worker rotates its own `trace_file`.
+    """
+    app = create_app(snapshot_file=snapshot_file, trace_file=trace_file, max_message_size=ws_max_size)
+    prewarm()
+
+    config = uvicorn.Config(
+        app,
+        loop="uvloop" if find_spec("uvloop") else "asyncio",
+        http="httptools" if find_spec("httptools") else "h11",
+        lifespan="on",
+        proxy_headers=True,
+        ws_max_size=ws_max_size,
+        ws_max_queue=ws_max_queue,
+        ws_per_message_deflate=ws_per_message_deflate,
+    )
+    config.load()
+
+    server = DrainingServer(
+        config,
+        connection_manager_registry=app.state.connection_manager_registry,
+        reconnect_delay=reconnect_delay,
+        reconnect_jitter=reconnect_jitter,
+        snapshotter=app.state.snapshotter,
+    )
+    server.run(sockets=[bind_socket(host=host, port=port, reuse_port=reuse_port)])
+
+
+def main() -> None:
+    parser = ArgumentParser(description="Runs the Lounge server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes. Workers don't share chat state, members of a room only see each other"
+        " if they are connected to the same worker.",
+    )
+    parser.add_argument("--reconnect-delay", type=float, default=1, help="Minimum reconnect delay in seconds.")
+    parser.add_argument(
+        "--reconnect-jitter", type=float, default=10, help="Maximum added reconnect delay in seconds."
+    )
+    parser.add_argument("--ws-max-size", type=int, default=64 * 1024, help="Maximum websocket message size in bytes.")
+    parser.add_argument("--ws-max-queue", type=int, default=8, help="Maximum number of queued incoming messages.")
+    parser.add_argument("--ws-per-message-deflate", action="store_true", help="Enable websocket compression.")
+    args = parser.parse_args()
+
+    worker_kwargs: dict[str, Any] = {
+        "host": args.host,
+        "port": args.port,
+        "reuse_port": args.workers > 1,
+        "reconnect_delay": args.reconnect_delay,
+        "reconnect_jitter": args.reconnect_jitter,
+        "ws_max_size": args.ws_max_size,
+        "ws_max_queue": args.ws_max_queue,
+        "ws_per_message_deflate": args.ws_per_message_deflate,
+    }
+
+    if args.workers == 1:
+        run_worker(**worker_kwargs)
+        return
+
+    if not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("Multiple workers require SO_REUSEPORT support.")
+
+    _logger.warning(
+        "Running %d workers that don't share chat state: members of a room only see each other's messages,"
+        " direct messages and search results if they are connected to the same worker.",
+        args.workers,
+    )
+
+    settings = get_settings()
+    snapshot_file = settings.snapshot_file
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(
+            target=run_worker,
+            kwargs={
+                **worker_kwargs,
+                "snapshot_file": None if snapshot_file is None else f"{snapshot_file}.{i}",
+                "trace_file": f"{settings.trace_file}.{i}",
+            },
+        )
+        for i in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    def forward_sigterm(_signum: int, _frame: object) -> None:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()  # Sends SIGTERM, workers drain gracefully.
+
+    signal.signal(signal.SIGTERM, forward_sigterm)
+    # Terminal interrupts reach the workers directly, forwarding them would force an immediate exit.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()
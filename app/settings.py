@@ -10,6 +10,34 @@ class Settings(BaseSettings):
 
     jwt_key: str
 
+    smtp_host: str | None = None
+    smtp_port: int = 587
+    smtp_username: str | None = None
+    smtp_password: str | None = None
+    smtp_sender: str = "lounge@localhost"
+    smtp_start_tls: bool = True
+    smtp_pool_size: int = 4
+
+    websocket_auth_middleware: bool = False
+
+    headless: bool = False
+
+    revocation_file: str = ".revoked-tokens"
+
+    message_max_length: int = 4000
+    message_blocked_words: list[str] = []
+    message_mask_links: bool = False
+    message_filter_processes: int = 0
+
+    snapshot_file: str | None = None
+    snapshot_interval: float = 60
+    snapshot_reconnect_grace: float = 30
+
+    trace_sample_rate: float = 0
+    trace_file: str = "lounge-traces.jsonl"
+    trace_file_max_bytes: int = 10 * 1024 * 1024
+    trace_file_backup_count: int = 5
+
     class Config:
         env_file = ".env"
 
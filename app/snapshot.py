@@ -0,0 +1,258 @@
+from __future__ import annotations
+from typing import Any, Callable, Iterator
+
+import asyncio
+from contextlib import contextmanager
+import gc
+import logging
+import marshal
+import os
+import threading
+import time
+
+from .message_index import MessageIndex
+from .room_directory import RoomDirectory
+
+_logger = logging.getLogger(__name__)
+
+_MAGIC = b"LOUNGE-SNAPSHOT\x02"
+"""
+File header, the last byte is the version of the snapshot layout.
+
+The header is followed by length-prefixed `marshal` records: the metadata with the room directory,
+then the message history in chunks of rooms.
+"""
+
+_CHUNK_SIZE = 100
+"""
+The number of rooms whose history is copied or encoded in one go.
+
+`marshal` holds the GIL while it encodes an object, so the history is encoded in chunks to let the
+event loop run while the periodic snapshots are written in a thread.
+"""
+
+
+class StateSnapshotter:
+    """
+    Saves the in-memory chat state to a binary snapshot file and restores it, so a restarted server
+    resumes with the history and the room set of the previous one instead of a cold state.
+
+    The snapshot contains the message history of the rooms (including their sequence counters and
+    search indexes) and the room directory with the last known occupancy of every room. Connections
+    can't survive a restart: clients reconnect, and the occupancy of the rooms nobody rejoined is
+    reset by `reconcile()`.
+
+    The snapshot is a series of `marshal` dumps of built-in types, which are fast to write and read.
+    Snapshots written by a different Python version or in an unknown layout are ignored.
+    """
+
+    __slots__ = (
+        "_interval",
+        "_lock",
+        "_message_index",
+        "_path",
+        "_room_directory",
+        "_saved_at",
+        "_sealed",
+        "_task",
+    )
+
+    def __init__(
+        self, path: str, *, message_index: MessageIndex, room_directory: RoomDirectory, interval: float = 60
+    ) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            path: The path of the snapshot file.
+            message_index: The message history to save and restore.
+            room_directory: The room directory to save and restore.
+            interval: The number of seconds between two periodic snapshots, no periodic snapshots if not positive.
+        """
+        self._path = path
+        self._message_index = message_index
+        self._room_directory = room_directory
+        self._interval = interval
+        self._sealed = False
+        self._task: asyncio.Task | None = None
+        # Serializes the writes of the periodic snapshot thread and the event loop.
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+
+    def save(self) -> None:
+        """
+        Writes the current state to the snapshot file, replacing the previous snapshot atomically.
+        """
+        self._write(self._take())
+
+    def seal(self) -> None:
+        """
+        Saves the current state for the last time.
+
+        Call it when the server starts draining, before the connections are closed, so the snapshot
+        still contains the occupancy of the rooms. Later saves are skipped.
+        """
+        if not self._sealed:
+            self.save()
+            self._sealed = True
+
+    def restore(self) -> bool:
+        """
+        Loads the state from the snapshot file, if there is a valid one.
+
+        Returns:
+            Whether the state was restored.
+        """
+        try:
+            with open(self._path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+
+        try:
+            if not data.startswith(_MAGIC):
+                raise ValueError("Unknown snapshot format.")
+
+            with _gc_paused():
+                records = list(_iter_records(data, len(_MAGIC)))
+                if not records:
+                    raise ValueError("Empty snapshot.")
+
+                marshal_version, created_at, room_directory, chunks = marshal.loads(records[0])
+                if marshal_version != marshal.version:
+                    raise ValueError("Snapshot written with a different marshal version.")
+                if len(records) != chunks + 1:
+                    raise ValueError("Unexpected number of snapshot records.")
+
+                message_index = [item for record in records[1:] for item in marshal.loads(record)]
+
+                self._message_index.restore(message_index)
+                self._room_directory.restore(room_directory)
+        except (EOFError, KeyError, TypeError, ValueError):
+            _logger.warning("Ignoring invalid snapshot %s.", self._path, exc_info=True)
+            self._message_index.restore([])
+            self._room_directory.restore([])
+            return False
+
+        _logger.info("Restored the snapshot taken %.1f seconds ago from %s.", time.time() - created_at, self._path)
+        return True
+
+    def reconcile(self, get_occupancy: Callable[[str], int]) -> None:
+        """
+        Replaces the restored occupancy of every room in the directory with the actual one.
+
+        Call it when the clients of the previous server had enough time to reconnect.
+
+        Arguments:
+            get_occupancy: Function that returns the actual number of connections in the given room.
+        """
+        # Rebuilt in one pass, removing the rooms one by one would take quadratic time.
+        room_directory = self._room_directory
+        room_directory.restore([(room, get_occupancy(room)) for room, _ in room_directory.snapshot()])
+
+    async def start(self) -> None:
+        """
+        Starts taking periodic snapshots.
+        """
+        if self._task is None and self._interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops taking periodic snapshots and saves the current state unless the snapshotter is sealed.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        if not self._sealed:
+            self.save()
+
+    async def _run(self) -> None:
+        """
+        Task that takes the periodic snapshots.
+        """
+        while True:
+            await asyncio.sleep(self._interval)
+            if self._sealed:
+                return
+
+            try:
+                # The state is copied on the event loop in chunks, then it's encoded and written in a thread.
+                taken_at = time.time()
+                message_index: list[list[tuple[str, tuple[Any, ...]]]] = []
+                for chunk in self._message_index.iter_snapshot(chunk_size=_CHUNK_SIZE):
+                    message_index.append(chunk)
+                    await asyncio.sleep(0)
+
+                state = (marshal.version, taken_at, message_index, self._room_directory.snapshot())
+                await asyncio.to_thread(self._write, state)
+            except Exception:
+                # E.g. a full disk, or a value marshal can't encode. Keep trying, the next state may be fine.
+                _logger.exception("Failed to save snapshot %s.", self._path)
+
+    def _take(self) -> tuple[Any, ...]:
+        """
+        Returns a copy of the current state that doesn't share mutable objects with the live state.
+        """
+        with _gc_paused():
+            return (
+                marshal.version,
+                time.time(),
+                list(self._message_index.iter_snapshot(chunk_size=_CHUNK_SIZE)),
+                self._room_directory.snapshot(),
+            )
+
+    def _write(self, state: tuple[Any, ...]) -> None:
+        """
+        Writes the given state to the snapshot file, unless a more recent state has already been written.
+        """
+        version, taken_at, message_index, room_directory = state
+        records = [marshal.dumps((version, taken_at, room_directory, len(message_index)))]
+        records.extend(marshal.dumps(chunk) for chunk in message_index)
+        with self._lock:
+            if taken_at < self._saved_at:
+                return
+
+            tmp_path = f"{self._path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(_MAGIC)
+                for record in records:
+                    f.write(len(record).to_bytes(8, "little"))
+                    f.write(record)
+            os.replace(tmp_path, self._path)
+            self._saved_at = taken_at
+
+
+def _iter_records(data: bytes, start: int) -> Iterator[memoryview]:
+    """
+    Returns the length-prefixed records of the given snapshot data, starting at the given offset.
+
+    Raises:
+        ValueError: If the last record is truncated.
+    """
+    view = memoryview(data)
+    while start < len(view):
+        end = start + 8 + int.from_bytes(view[start : start + 8], "little")
+        if end > len(view):
+            raise ValueError("Truncated snapshot record.")
+
+        yield view[start + 8 : end]
+        start = end
+
+
+@contextmanager
+def _gc_paused() -> Iterator[None]:
+    """
+    Disables the cyclic garbage collector in the context.
+
+    Copying the state allocates millions of acyclic containers, which would trigger many useless collections.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
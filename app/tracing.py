@@ -0,0 +1,288 @@
+from __future__ import annotations
+from typing import Any, Hashable
+
+from contextvars import ContextVar
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+from queue import Full, Queue
+import random
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+current_trace: ContextVar[MessageTrace | None] = ContextVar("current_trace", default=None)
+"""
+The trace of the message that is being delivered, `None` if the message is not sampled.
+
+Connection managers read it to record the deliveries of traced messages.
+"""
+
+
+class MessageTrace:
+    """
+    Trace of a single chat message from its receipt to its last delivery.
+
+    Stages of the request handler are recorded as consecutive spans with `lap()`, deliveries are
+    recorded by the connection managers with `begin_delivery()` and `end_delivery()`, and only the
+    slowest delivery is kept. The trace is exported once the handler called `end()` and every
+    delivery completed.
+    """
+
+    __slots__ = (
+        "_ended",
+        "_exporter",
+        "_offset_ns",
+        "_pending",
+        "_slowest",
+        "attributes",
+        "deliveries",
+        "dropped",
+        "end_ns",
+        "last_ns",
+        "spans",
+        "start_ns",
+        "trace_id",
+    )
+
+    def __init__(self, *, exporter: TraceFileExporter) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            exporter: The exporter that receives the trace when it's complete.
+        """
+        self._exporter = exporter
+        self._ended = False
+        self._pending = 0
+        # (duration, recipient, queued at, sent at, delivered at), the slowest delivery.
+        self._slowest: tuple[int, Hashable, int, int, int] | None = None
+        self.trace_id = os.urandom(16).hex()
+        self.attributes: dict[str, Any] = {}  # The attributes of the root span.
+        self.spans: list[tuple[str, int, int]] = []  # (name, start, end)
+        self.deliveries = 0
+        self.dropped = 0
+        # Timestamps are taken with perf_counter_ns(), the offset converts them to UNIX time.
+        self.start_ns = self.last_ns = self.end_ns = time.perf_counter_ns()
+        self._offset_ns = time.time_ns() - self.start_ns
+
+    def lap(self, name: str) -> None:
+        """
+        Records a span with the given name from the end of the previous span (or the start of the trace) until now.
+
+        Arguments:
+            name: The name of the span.
+        """
+        now = time.perf_counter_ns()
+        self.spans.append((name, self.last_ns, now))
+        self.last_ns = now
+
+    def begin_delivery(self) -> None:
+        """
+        Records that the message was scheduled for delivery to a connection.
+        """
+        self._pending += 1
+
+    def end_delivery(self, *, recipient: Hashable, queued_at: int, sent_at: int, delivered: bool = True) -> None:
+        """
+        Records the completion of a delivery that was started with `begin_delivery()`.
+
+        Arguments:
+            recipient: The user the message was sent to.
+            queued_at: The `perf_counter_ns()` time when the message was scheduled for delivery.
+            sent_at: The `perf_counter_ns()` time when sending the message started.
+            delivered: Whether the message was sent, `False` if it was dropped.
+        """
+        now = time.perf_counter_ns()
+        self._pending -= 1
+        if delivered:
+            self.deliveries += 1
+            if self._slowest is None or now - queued_at > self._slowest[0]:
+                self._slowest = (now - queued_at, recipient, queued_at, sent_at, now)
+        else:
+            self.dropped += 1
+
+        self.end_ns = max(self.end_ns, now)
+        if self._ended and self._pending == 0:
+            self._exporter.export(self)
+
+    def end(self) -> None:
+        """
+        Records that the request handler finished processing the message.
+        """
+        self._ended = True
+        self.end_ns = max(self.end_ns, self.last_ns)
+        if self._pending == 0:
+            self._exporter.export(self)
+
+    def to_otlp(self) -> dict[str, Any]:
+        """
+        Returns the trace as an OTLP/JSON `ExportTraceServiceRequest`.
+        """
+        offset, trace_id = self._offset_ns, self.trace_id
+        root_id = os.urandom(8).hex()
+
+        def make_span(
+            name: str, start: int, end: int, attributes: dict[str, Any], parent_id: str | None = root_id
+        ) -> dict[str, Any]:
+            span: dict[str, Any] = {
+                "traceId": trace_id,
+                "spanId": root_id if parent_id is None else os.urandom(8).hex(),
+                "name": name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(start + offset),
+                "endTimeUnixNano": str(end + offset),
+                "attributes": [{"key": key, "value": _make_otlp_value(value)} for key, value in attributes.items()],
+            }
+            if parent_id is not None:
+                span["parentSpanId"] = parent_id
+            return span
+
+        root_attributes = {**self.attributes, "lounge.fan_out": self.deliveries, "lounge.dropped": self.dropped}
+        spans = [make_span(name, start, end, {}) for name, start, end in self.spans]
+        if self._slowest is not None:
+            duration, recipient, queued_at, sent_at, delivered_at = self._slowest
+            root_attributes["lounge.slowest_recipient"] = str(recipient)
+            root_attributes["lounge.slowest_delivery_ns"] = duration
+            spans.append(
+                make_span(
+                    "chat.deliver",
+                    queued_at,
+                    delivered_at,
+                    {
+                        "lounge.recipient": str(recipient),
+                        "lounge.queue_wait_ns": sent_at - queued_at,
+                        "lounge.send_ns": delivered_at - sent_at,
+                    },
+                )
+            )
+
+        spans.insert(0, make_span("chat.message", self.start_ns, self.end_ns, root_attributes, parent_id=None))
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "lounge"}}]},
+                    "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+                }
+            ]
+        }
+
+
+def _make_otlp_value(value: Any) -> dict[str, Any]:
+    """
+    Converts the given attribute value to an OTLP/JSON `AnyValue`.
+    """
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class TraceFileExporter:
+    """
+    Writes completed traces to a size-rotated file, one OTLP/JSON `ExportTraceServiceRequest` per line,
+    the format of the OpenTelemetry collector's file exporter and `otlpjsonfile` receiver.
+
+    Traces are encoded and written by a background thread. If the thread falls behind, traces are dropped
+    instead of blocking the event loop.
+    """
+
+    __slots__ = (
+        "_handler",
+        "_queue",
+        "_thread",
+    )
+
+    def __init__(self, path: str, *, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            path: The path of the trace file.
+            max_bytes: The size at which the trace file is rotated.
+            backup_count: The number of rotated trace files to keep.
+        """
+        self._handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self._queue: Queue[MessageTrace | None] = Queue(maxsize=1024)
+        self._thread: threading.Thread | None = None
+
+    def export(self, trace: MessageTrace) -> None:
+        """
+        Queues the given trace for writing.
+
+        Arguments:
+            trace: The completed trace.
+        """
+        try:
+            self._queue.put_nowait(trace)
+        except Full:
+            pass
+
+    def start(self) -> None:
+        """
+        Starts the writer thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Writes the queued traces and stops the writer thread.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+        self._handler.close()
+
+    def _run(self) -> None:
+        """
+        Writer thread.
+        """
+        handler, queue = self._handler, self._queue
+        while (trace := queue.get()) is not None:
+            try:
+                handler.emit(logging.makeLogRecord({"msg": json.dumps(trace.to_otlp(), separators=(",", ":"))}))
+            except Exception:
+                _logger.exception("Failed to export trace %s.", trace.trace_id)
+
+
+class MessageTracer:
+    """
+    Samples chat messages for tracing.
+    """
+
+    __slots__ = (
+        "_exporter",
+        "_sample_rate",
+    )
+
+    def __init__(self, exporter: TraceFileExporter, *, sample_rate: float) -> None:
+        """
+        Initialization.
+
+        Arguments:
+            exporter: The exporter of the completed traces.
+            sample_rate: The fraction of messages to trace, between 0 and 1.
+        """
+        self._exporter = exporter
+        self._sample_rate = sample_rate
+
+    def sample(self) -> MessageTrace | None:
+        """
+        Starts a trace for the current message if it's sampled.
+
+        Returns:
+            The new trace, or `None` if the message is not sampled.
+        """
+        if random.random() >= self._sample_rate:
+            return None
+
+        return MessageTrace(exporter=self._exporter)
@@ -0,0 +1,53 @@
+"""
+Websocket handshakes per second with the token verified by the `get_user_token()` dependency chain
+and with `WebSocketAuthMiddleware` (`WEBSOCKET_AUTH_MIDDLEWARE=true`).
+
+Every handshake opens a connection to its own room, waits for the welcome message and closes it.
+Clients reuse a fixed set of tokens, like reconnecting users do.
+
+Usage: `python -m benchmarks.handshakes --handshakes 2000 --concurrency 50`
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser
+import asyncio
+import time
+
+from websockets.asyncio.client import connect
+
+from .server import make_token, run_server
+
+
+async def run(*, port: int, handshakes: int, concurrency: int, users: int) -> float:
+    tokens = [make_token(f"user{i}") for i in range(users)]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handshake(i: int) -> None:
+        async with semaphore:
+            async with connect(
+                f"ws://127.0.0.1:{port}/chat/room{i}/ws", additional_headers={"Cookie": f"X-User={tokens[i % users]}"}
+            ) as ws:
+                await ws.recv()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(handshake(i) for i in range(handshakes)))
+    return handshakes / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--handshakes", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--users", type=int, default=100)
+    args = parser.parse_args()
+
+    for name, middleware in (("dependency", "false"), ("middleware", "true")):
+        with run_server(env={"WEBSOCKET_AUTH_MIDDLEWARE": middleware}) as (_, port):
+            rate = asyncio.run(
+                run(port=port, handshakes=args.handshakes, concurrency=args.concurrency, users=args.users)
+            )
+            print(f"{name:10} {rate:8.0f} handshakes/s")
+
+
+if __name__ == "__main__":
+    main()
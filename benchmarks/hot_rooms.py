@@ -0,0 +1,136 @@
+"""
+Latency of quiet rooms while another room on the same server is busy.
+
+Cold rooms have two members each, one of them sends a message every 50 ms and the other one
+records how long it took to arrive. The latency is measured first on an otherwise idle server,
+then while a hot room with `--hot-receivers` members gets `--hot-rate` messages per second.
+
+Usage: `python -m benchmarks.hot_rooms --hot-receivers 1000 --hot-rate 50 --cold-rooms 20`
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser
+import asyncio
+import json
+import statistics
+import time
+
+from websockets.asyncio.client import connect, ClientConnection
+
+from .server import make_token, run_server
+
+
+async def open_connection(port: int, room: str, name: str) -> ClientConnection:
+    ws = await connect(
+        f"ws://127.0.0.1:{port}/chat/{room}/ws", additional_headers={"Cookie": f"X-User={make_token(name)}"}
+    )
+    await ws.recv()  # The welcome message, the connection joined the room.
+    return ws
+
+
+async def probe_cold_room(port: int, room: int, duration: float, latencies: list[float]) -> None:
+    """
+    Sends a timestamped message every 50 ms from one member of the room and records its latency at the other.
+    """
+    sender = await open_connection(port, f"cold{room}", f"cold{room}a")
+    receiver = await open_connection(port, f"cold{room}", f"cold{room}b")
+
+    async def receive() -> None:
+        async for data in receiver:
+            message = json.loads(data)["message"]
+            if message.startswith("ping "):
+                latencies.append(time.perf_counter() - float(message[5:]))
+
+    receiving = asyncio.create_task(receive())
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        await sender.send(f"ping {time.perf_counter()!r}")
+        await asyncio.sleep(0.05)
+
+    await asyncio.sleep(0.5)
+    receiving.cancel()
+    await sender.close()
+    await receiver.close()
+
+
+async def run_hot_room(port: int, *, receivers: int, rate: float, stop: asyncio.Event) -> int:
+    """
+    Sends `rate` messages per second to a room with `receivers` members until `stop` is set.
+
+    Returns:
+        The number of delivered messages.
+    """
+    connections = [await open_connection(port, "hot", f"hot{i}") for i in range(receivers)]
+    delivered = 0
+
+    async def drain(ws: ClientConnection) -> None:
+        nonlocal delivered
+        async for _ in ws:
+            delivered += 1
+
+    draining = [asyncio.create_task(drain(ws)) for ws in connections]
+    sender = await open_connection(port, "hot", "hot-sender")
+    i = 0
+    while not stop.is_set():
+        await sender.send(f"hot message {i}")
+        i += 1
+        await asyncio.sleep(1 / rate)
+
+    for task in draining:
+        task.cancel()
+    for ws in (sender, *connections):
+        await ws.close()
+
+    return delivered
+
+
+async def measure(port: int, *, cold_rooms: int, duration: float, hot_receivers: int, hot_rate: float) -> None:
+    for loaded in (False, True):
+        stop = asyncio.Event()
+        hot = (
+            asyncio.create_task(run_hot_room(port, receivers=hot_receivers, rate=hot_rate, stop=stop))
+            if loaded
+            else None
+        )
+        if hot is not None:
+            await asyncio.sleep(2)  # Let the hot room fill up.
+
+        latencies: list[float] = []
+        start = time.perf_counter()
+        await asyncio.gather(*(probe_cold_room(port, room, duration, latencies) for room in range(cold_rooms)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        delivered = 0 if hot is None else await hot
+
+        latencies.sort()
+        print(
+            f"{'hot room busy' if loaded else 'idle server':14}"
+            f" cold latency p50 {statistics.median(latencies) * 1000:7.2f} ms"
+            f" p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.2f} ms"
+            f" max {latencies[-1] * 1000:7.2f} ms"
+            f" hot deliveries {delivered / elapsed:8.0f}/s"
+        )
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--hot-receivers", type=int, default=1000)
+    parser.add_argument("--hot-rate", type=float, default=50)
+    parser.add_argument("--cold-rooms", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    with run_server() as (_, port):
+        asyncio.run(
+            measure(
+                port,
+                cold_rooms=args.cold_rooms,
+                duration=args.duration,
+                hot_receivers=args.hot_receivers,
+                hot_rate=args.hot_rate,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
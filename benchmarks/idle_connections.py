@@ -0,0 +1,139 @@
+"""
+Memory cost of idle websocket connections.
+
+Serves the application in this process with `tracemalloc` enabled, opens `--connections` idle chat
+connections from a client process, and reports the growth of the traced Python memory and of the
+RSS of the server per connection.
+
+Usage: `python -m benchmarks.idle_connections --connections 10000`
+
+Every socket needs a file descriptor on both sides, so raise `ulimit -n` above the number of connections.
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser, Namespace, SUPPRESS
+import asyncio
+import gc
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+import uvicorn
+
+from .server import free_port, get_rss, JWT_KEY, make_token
+
+
+def raise_file_limit() -> None:
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def open_connections(*, port: int, connections: int, room_size: int, users: int) -> None:
+    """
+    Client process: opens the connections, prints `ready`, and keeps them open until stdin is closed.
+    """
+    from websockets.asyncio.client import connect
+
+    tokens = [make_token(f"user{i}") for i in range(users)]
+    semaphore = asyncio.Semaphore(100)
+    opened = []
+
+    async def open_connection(i: int) -> None:
+        async with semaphore:
+            ws = await connect(
+                f"ws://127.0.0.1:{port}/chat/room{i // room_size}/ws",
+                additional_headers={"Cookie": f"X-User={tokens[i % users]}"},
+                max_queue=None,
+            )
+            await ws.recv()  # Wait for the welcome message, the connection joined the room.
+            opened.append(ws)
+
+    await asyncio.gather(*(open_connection(i) for i in range(connections)))
+    print("ready", flush=True)
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.read)
+
+
+def measure(args: Namespace) -> None:
+    """
+    Server process: serves the application and measures the memory cost of the connections of the client process.
+    """
+    os.environ["JWT_KEY"] = JWT_KEY
+    from app.app import create_app
+
+    port = free_port()
+    config = uvicorn.Config(
+        create_app(headless=True),
+        port=port,
+        log_level="warning",
+        ws_max_size=args.ws_max_size,
+        ws_max_queue=args.ws_max_queue,
+        ws_per_message_deflate=args.ws_per_message_deflate,
+    )
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    tracemalloc.start()
+    gc.collect()
+    traced_before, rss_before = tracemalloc.get_traced_memory()[0], get_rss(os.getpid())
+
+    client = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.idle_connections",
+            "--client",
+            f"--port={port}",
+            f"--connections={args.connections}",
+            f"--room-size={args.room_size}",
+            f"--users={args.users}",
+        ],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        if client.stdout.readline().strip() != "ready":  # type: ignore[union-attr]
+            raise RuntimeError("The client process failed.")
+
+        time.sleep(1)  # Let the join notifications settle.
+        gc.collect()
+        traced = (tracemalloc.get_traced_memory()[0] - traced_before) / args.connections
+        rss = (get_rss(os.getpid()) - rss_before) / args.connections
+        print(f"{args.connections} connections: {traced:8.0f} B/connection traced, {rss:8.0f} B/connection RSS")
+    finally:
+        client.stdin.close()  # type: ignore[union-attr]
+        client.wait()
+        server.should_exit = True
+        thread.join()
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--room-size", type=int, default=10)
+    parser.add_argument("--users", type=int, default=1000, help="Users share tokens across their connections.")
+    parser.add_argument("--ws-max-size", type=int, default=64 * 1024)
+    parser.add_argument("--ws-max-queue", type=int, default=8)
+    parser.add_argument("--ws-per-message-deflate", action="store_true")
+    parser.add_argument("--client", action="store_true", help=SUPPRESS)
+    parser.add_argument("--port", type=int, default=0, help=SUPPRESS)
+    args = parser.parse_args()
+
+    raise_file_limit()
+    if args.client:
+        asyncio.run(
+            open_connections(port=args.port, connections=args.connections, room_size=args.room_size, users=args.users)
+        )
+    else:
+        measure(args)
+
+
+if __name__ == "__main__":
+    main()
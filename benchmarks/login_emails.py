@@ -0,0 +1,104 @@
+"""
+Login email throughput against a local `aiosmtpd` server.
+
+Compares sending every login email on its own SMTP connection (what an inline `send_login_email`
+does) with `LoginEmailDispatcher` on top of `SMTPConnectionPool`.
+
+Usage: `python -m benchmarks.login_emails --emails 2000` (requires `pip install aiosmtpd`).
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser
+import asyncio
+import threading
+import time
+
+import aiosmtplib
+from aiosmtpd.controller import Controller
+
+from app.email_auth_api import User
+from app.email_dispatch import LoginEmail, LoginEmailDispatcher, SMTPConnectionPool
+
+
+class CountingHandler:
+    """
+    `aiosmtpd` handler that counts the received messages.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.target = 0
+        self.done = threading.Event()
+
+    async def handle_DATA(self, server, session, envelope) -> str:
+        self.count += 1
+        if self.count >= self.target:
+            self.done.set()
+        return "250 OK"
+
+    def expect(self, count: int) -> None:
+        self.count = 0
+        self.target = count
+        self.done.clear()
+
+
+def make_emails(count: int) -> list[LoginEmail]:
+    return [
+        LoginEmail(user=User(name=f"user{i}", email=f"user{i}@example.com"), token="token", request_url="http://x/")
+        for i in range(count)
+    ]
+
+
+async def send_inline(*, hostname: str, port: int, emails: list[LoginEmail], concurrency: int) -> None:
+    """
+    Sends every email on a new connection, with at most `concurrency` emails in flight.
+    """
+    pool = SMTPConnectionPool(hostname=hostname, port=port, sender="lounge@localhost", start_tls=False)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(email: LoginEmail) -> None:
+        async with semaphore:
+            await aiosmtplib.send(pool._make_message(email), hostname=hostname, port=port)
+
+    await asyncio.gather(*(send(email) for email in emails))
+
+
+async def send_dispatched(*, hostname: str, port: int, emails: list[LoginEmail], concurrency: int) -> None:
+    """
+    Enqueues every email in `LoginEmailDispatcher` and waits for the queue to drain.
+    """
+    pool = SMTPConnectionPool(
+        hostname=hostname, port=port, sender="lounge@localhost", start_tls=False, size=concurrency
+    )
+    dispatcher = LoginEmailDispatcher(transport=pool, worker_count=concurrency, max_queue_size=len(emails))
+    await dispatcher.start()
+    for email in emails:
+        await dispatcher(user=email.user, token=email.token, request_url=email.request_url)
+    await dispatcher.stop(timeout=600)
+    await pool.close()
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--emails", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    handler = CountingHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=8025)
+    controller.start()
+    try:
+        for name, send in (("inline, one connection per email", send_inline), ("dispatcher + pool", send_dispatched)):
+            emails = make_emails(args.emails)
+            handler.expect(len(emails))
+            start = time.perf_counter()
+            asyncio.run(send(hostname="127.0.0.1", port=8025, emails=emails, concurrency=args.concurrency))
+            handler.done.wait()
+            elapsed = time.perf_counter() - start
+            print(f"{name:34} {len(emails) / elapsed:10.0f} logins/s")
+    finally:
+        controller.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Indexing throughput, memory and search latency of `MessageIndex` with a million messages.
+
+Messages are random sentences over a Zipf-distributed vocabulary, spread across `--rooms` rooms
+that each retain `--messages // --rooms` messages (the default room limit).
+
+Usage: `python -m benchmarks.message_index --messages 1000000 --rooms 100`
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser
+import gc
+import itertools
+import os
+import random
+import statistics
+import time
+
+from app.message_index import MessageIndex
+
+from .server import get_rss
+
+
+def make_texts(count: int, *, vocabulary: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    words = [f"word{i}" for i in range(vocabulary)]
+    cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(vocabulary)))
+    return [" ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(3, 20))) for _ in range(count)]
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--vocabulary", type=int, default=50_000)
+    parser.add_argument("--searches", type=int, default=200)
+    args = parser.parse_args()
+
+    texts = make_texts(args.messages, vocabulary=args.vocabulary)
+    index = MessageIndex(max_rooms=args.rooms, max_messages_per_room=args.messages // args.rooms)
+
+    gc.collect()
+    rss_before = get_rss(os.getpid())
+    start = time.perf_counter()
+    for i, text in enumerate(texts):
+        index.add(f"room{i % args.rooms}", text, user_name="user", user_email="user@example.com")
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    memory = get_rss(os.getpid()) - rss_before
+    print(f"indexing {args.messages / elapsed:10.0f} messages/s, {memory / args.messages:6.0f} B/message RSS")
+
+    rng = random.Random(1)
+    for name, query in (("common term", "word0"), ("rare term", "word40000"), ("3 terms", "word1 word50 word900")):
+        latencies = []
+        pages = 0
+        for _ in range(args.searches):
+            room = f"room{rng.randrange(args.rooms)}"
+            start = time.perf_counter()
+            page = index.search(room, query, limit=20)
+            latencies.append(time.perf_counter() - start)
+            if page.cursor is not None:  # Fetch the second page too, to check the cursor path.
+                index.search(room, query, after=page.cursor, limit=20)
+                pages += 1
+
+        latencies.sort()
+        print(
+            f"search {name:12} p50 {statistics.median(latencies) * 1000:7.2f} ms"
+            f" p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.2f} ms ({pages} second pages)"
+        )
+
+
+if __name__ == "__main__":
+    main()
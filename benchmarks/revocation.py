@@ -0,0 +1,89 @@
+"""
+Event loop stalls caused by the revocation store with a large denylist.
+
+Fills a `RevocationStore` with `--entries` live revocations, then measures the lag of a 1 ms ticker
+task while the store is synced and purged, first on the event loop (like a lookup that syncs
+inline), then in the background with `start()`. Also reports the cost of a lookup.
+
+Usage: `python -m benchmarks.revocation --entries 1000000`
+"""
+from __future__ import annotations
+from typing import Awaitable, Callable
+
+from argparse import ArgumentParser
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import timeit
+
+from app.revocation import RevocationStore
+
+
+def make_store(path: str, entries: int) -> RevocationStore:
+    expires_at = time.time() + 3600
+    with open(path, "w") as f:
+        f.writelines(f"token{i} {expires_at}\n" for i in range(entries))
+
+    store = RevocationStore(path, sync_interval=0.1, purge_interval=0.5)
+    store.sync()
+    return store
+
+
+async def measure_lag(duration: float) -> list[float]:
+    """
+    Returns the lag of a ticker task that wakes up every millisecond for `duration` seconds.
+    """
+    lags: list[float] = []
+    end = time.perf_counter() + duration
+    while (now := time.perf_counter()) < end:
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - now - 0.001)
+
+    return lags
+
+
+async def sync_inline(store: RevocationStore, duration: float) -> list[float]:
+    async def sync() -> None:
+        while True:
+            await asyncio.sleep(0.1)
+            store.sync()
+
+    task = asyncio.create_task(sync())
+    try:
+        return await measure_lag(duration)
+    finally:
+        task.cancel()
+
+
+async def sync_in_background(store: RevocationStore, duration: float) -> list[float]:
+    await store.start()
+    try:
+        return await measure_lag(duration)
+    finally:
+        await store.stop()
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    parser.add_argument("--duration", type=float, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = make_store(os.path.join(directory, "revoked"), args.entries)
+        lookup = timeit.timeit(lambda: store.is_revoked("token-unknown"), number=100_000) / 100_000
+        print(f"lookup {lookup * 1e9:.0f} ns")
+
+        mode: Callable[[RevocationStore, float], Awaitable[list[float]]]
+        for name, mode in (("sync on the event loop", sync_inline), ("sync in the background", sync_in_background)):
+            lags = sorted(asyncio.run(mode(store, args.duration)))
+            print(
+                f"{name:24} loop lag p50 {statistics.median(lags) * 1000:6.2f} ms"
+                f" p99 {lags[int(len(lags) * 0.99)] * 1000:6.2f} ms max {lags[-1] * 1000:6.2f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Helpers that run the application in a separate process for the benchmarks.
+"""
+from __future__ import annotations
+from typing import Iterator
+
+from contextlib import contextmanager
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from jose import jwt
+
+JWT_KEY = "benchmark-jwt-key"
+
+
+def make_token(name: str) -> str:
+    """
+    Returns a signed user token (the `X-User` cookie) for the given user name.
+    """
+    now = time.time()
+    claims = {"name": name, "email": f"{name}@example.com", "created_at": now, "exp": now + 3600, "jti": name}
+    return jwt.encode(claims, JWT_KEY)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_rss(pid: int) -> int:
+    """
+    Returns the resident set size of the given process in bytes (Linux only).
+    """
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+
+    raise RuntimeError("VmRSS not found.")
+
+
+def wait_for_port(port: int, *, timeout: float = 30) -> None:
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+@contextmanager
+def run_server(*args: str, env: dict[str, str] | None = None) -> Iterator[tuple[subprocess.Popen, int]]:
+    """
+    Runs `python -m app.serve` on a free port and yields the process and the port once it accepts connections.
+
+    Arguments:
+        args: Extra command line arguments of `app.serve`.
+        env: Extra environment variables (settings) of the server.
+    """
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "app.serve",
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--reconnect-jitter",
+            "0",
+            *args,
+        ],
+        env={**os.environ, "JWT_KEY": JWT_KEY, "HEADLESS": "true", **(env or {})},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+        yield process, port
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
@@ -0,0 +1,115 @@
+"""
+Save and restore time of the chat state snapshot with many rooms.
+
+Fills a `MessageIndex` and a `RoomDirectory` with `--rooms` rooms of `--messages-per-room` messages
+each, then measures `save()`, `restore()` into an empty state and the first search in restored rooms
+(which rebuilds them), and the event loop lag of a 1 ms ticker task while a periodic snapshot is taken.
+
+Usage: `python -m benchmarks.snapshot --rooms 100000 --messages-per-room 5`
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from app.message_index import MessageIndex
+from app.room_directory import RoomDirectory
+from app.snapshot import StateSnapshotter
+
+WORDS = [f"word{i}" for i in range(1000)]
+
+
+def make_state(*, rooms: int, messages_per_room: int) -> tuple[MessageIndex, RoomDirectory]:
+    rng = random.Random(0)
+    message_index, room_directory = MessageIndex(max_rooms=rooms), RoomDirectory()
+    for i in range(rooms):
+        room = f"room{i}"
+        for _ in range(messages_per_room):
+            text = " ".join(rng.choices(WORDS, k=rng.randint(3, 20)))
+            message_index.add(room, text, user_name="user", user_email="user@example.com")
+        room_directory.update(room, rng.randint(1, 50))
+
+    return message_index, room_directory
+
+
+async def measure_periodic_save(snapshotter: StateSnapshotter, path: str) -> tuple[float, list[float]]:
+    """
+    Starts the periodic snapshots and waits for the first one to replace the snapshot file.
+
+    Returns:
+        The number of seconds it took to take and write the snapshot, and the lag of a ticker task
+        that woke up every millisecond in the meantime.
+    """
+    saved_at = os.stat(path).st_mtime_ns
+    await snapshotter.start()
+    due = time.perf_counter() + 1  # The interval is 1 second.
+    await asyncio.sleep(0.9)
+    lags: list[float] = []
+    while os.stat(path).st_mtime_ns == saved_at:
+        now = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - now - 0.001)
+
+    elapsed = time.perf_counter() - due
+    snapshotter.seal()  # Don't save again in `stop()`.
+    await snapshotter.stop()
+    return elapsed, lags
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=100_000)
+    parser.add_argument("--messages-per-room", type=int, default=5)
+    parser.add_argument("--searches", type=int, default=1000)
+    args = parser.parse_args()
+
+    message_index, room_directory = make_state(rooms=args.rooms, messages_per_room=args.messages_per_room)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "snapshot")
+        snapshotter = StateSnapshotter(path, message_index=message_index, room_directory=room_directory, interval=1)
+
+        start = time.perf_counter()
+        snapshotter.save()
+        elapsed = time.perf_counter() - start
+        print(f"save    {elapsed * 1000:8.0f} ms, {os.path.getsize(path) / 1024 / 1024:6.1f} MiB")
+
+        restored_index, restored_directory = MessageIndex(max_rooms=args.rooms), RoomDirectory()
+        restored = StateSnapshotter(path, message_index=restored_index, room_directory=restored_directory)
+        start = time.perf_counter()
+        if not restored.restore():
+            raise RuntimeError("The snapshot was not restored.")
+        elapsed = time.perf_counter() - start
+        print(f"restore {elapsed * 1000:8.0f} ms, {len(restored_directory)} rooms")
+
+        rng = random.Random(1)
+        latencies = []
+        for _ in range(args.searches):
+            room = f"room{rng.randrange(args.rooms)}"
+            start = time.perf_counter()
+            restored_index.search(room, "word1")
+            latencies.append(time.perf_counter() - start)
+
+        latencies.sort()
+        print(
+            f"first search in a restored room p50 {statistics.median(latencies) * 1000:6.2f} ms"
+            f" p99 {latencies[int(len(latencies) * 0.99)] * 1000:6.2f} ms"
+        )
+
+        elapsed, lags = asyncio.run(measure_periodic_save(snapshotter, path))
+        blocked = sum(lag for lag in lags if lag > 0)
+        lags.sort()
+        print(
+            f"periodic save {elapsed * 1000:8.0f} ms, event loop blocked {blocked * 1000:6.0f} ms"
+            f" ({blocked / elapsed:4.0%}), loop lag p99 {lags[int(len(lags) * 0.99)] * 1000:6.2f} ms"
+            f" max {lags[-1] * 1000:6.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
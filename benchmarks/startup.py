@@ -0,0 +1,79 @@
+"""
+Import time and cold start time of the application with and without the HTML pages (`HEADLESS`).
+
+Reports the time spent importing modules while creating the application (`python -X importtime`),
+the peak RSS after it, and the time from starting `python -m app.serve` to the first HTTP response.
+
+Usage: `python -m benchmarks.startup --runs 5`
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from .server import JWT_KEY, run_server
+
+IMPORT_SCRIPT = """
+import resource
+import app.app
+app.app.create_app()
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def measure_import(headless: bool) -> tuple[float, int]:
+    """
+    Returns the time spent importing modules while importing `app.app` and creating the application
+    in seconds, and the peak RSS of the process in bytes.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_SCRIPT],
+        env={**os.environ, "JWT_KEY": JWT_KEY, "HEADLESS": str(headless).lower()},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    import_us = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package, nested imports are indented.
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit() and not parts[2].startswith("  "):
+            import_us += int(parts[1])
+
+    return import_us / 1e6, int(result.stdout.split()[-1]) * 1024
+
+
+def measure_first_response(headless: bool) -> float:
+    """
+    Returns the number of seconds from starting the server to its first HTTP response.
+    """
+    start = time.perf_counter()
+    with run_server(env={"HEADLESS": str(headless).lower()}) as (_, port):
+        httpx.get(f"http://127.0.0.1:{port}/")
+        return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    for headless in (False, True):
+        imports = [measure_import(headless) for _ in range(args.runs)]
+        first_responses = [measure_first_response(headless) for _ in range(args.runs)]
+        print(
+            f"{'headless' if headless else 'full':8}"
+            f" import {statistics.median(t for t, _ in imports) * 1000:7.1f} ms"
+            f" max RSS {statistics.median(rss for _, rss in imports) / 1024 / 1024:6.1f} MiB"
+            f" first response {statistics.median(first_responses) * 1000:7.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
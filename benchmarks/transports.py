@@ -0,0 +1,114 @@
+"""
+Cost of the chat transports: websockets, server-sent events and long polling.
+
+For every transport, connects `--clients` receivers to a room of a fresh server, reports the
+server's RSS growth per connection, then sends `--messages` messages from a websocket client and
+reports the deliveries per second until every receiver got every message.
+
+Usage: `python -m benchmarks.transports --clients 200 --messages 200`
+"""
+from __future__ import annotations
+from typing import Awaitable, Callable
+
+from argparse import ArgumentParser
+import asyncio
+import json
+import time
+
+import httpx
+from websockets.asyncio.client import connect
+
+from .server import get_rss, make_token, run_server
+
+MARKER = "benchmark message"
+
+
+async def receive_ws(port: int, token: str, count: int, ready: asyncio.Event, connected: Callable[[], None]) -> None:
+    async with connect(
+        f"ws://127.0.0.1:{port}/chat/bench/ws", additional_headers={"Cookie": f"X-User={token}"}
+    ) as ws:
+        connected()
+        await ready.wait()
+        received = 0
+        while received < count:
+            if MARKER in await ws.recv():
+                received += 1
+
+
+async def receive_sse(port: int, token: str, count: int, ready: asyncio.Event, connected: Callable[[], None]) -> None:
+    async with httpx.AsyncClient(cookies={"X-User": token}, timeout=None) as client:
+        async with client.stream("GET", f"http://127.0.0.1:{port}/chat/bench/sse") as response:
+            received = 0
+            async for line in response.aiter_lines():
+                if line == "event: client":  # Sent after the client joined the room.
+                    connected()
+                elif line.startswith("data:") and MARKER in line:
+                    received += 1
+                    if received == count:
+                        return
+
+
+async def receive_poll(
+    port: int, token: str, count: int, ready: asyncio.Event, connected: Callable[[], None]
+) -> None:
+    async with httpx.AsyncClient(cookies={"X-User": token}, timeout=None) as client:
+        client_id = (await client.post(f"http://127.0.0.1:{port}/chat/bench/poll")).json()["client_id"]
+        connected()
+        await ready.wait()
+        cursor, received = 0, 0
+        while received < count:
+            response = await client.get(
+                f"http://127.0.0.1:{port}/chat/bench/poll/{client_id}", params={"cursor": cursor}
+            )
+            body = response.json()
+            cursor = body["cursor"]
+            received += sum(MARKER in json.loads(message)["message"] for message in body["messages"])
+
+        await client.delete(f"http://127.0.0.1:{port}/chat/bench/poll/{client_id}")
+
+
+Receiver = Callable[[int, str, int, asyncio.Event, Callable[[], None]], Awaitable[None]]
+
+
+async def run(receiver: Receiver, *, port: int, pid: int, clients: int, messages: int) -> None:
+    ready = asyncio.Event()
+    connected = asyncio.Semaphore(0)
+    rss_before = get_rss(pid)
+    tokens = [make_token(f"receiver{i}") for i in range(clients)]
+    receivers = [asyncio.create_task(receiver(port, token, messages, ready, connected.release)) for token in tokens]
+    for _ in range(clients):
+        await connected.acquire()
+
+    await asyncio.sleep(1)  # Let the join notifications settle.
+    rss_per_connection = (get_rss(pid) - rss_before) / clients
+
+    sender_token = make_token("sender")
+    async with connect(
+        f"ws://127.0.0.1:{port}/chat/bench/ws", additional_headers={"Cookie": f"X-User={sender_token}"}
+    ) as ws:
+        ready.set()
+        start = time.perf_counter()
+        for i in range(messages):
+            await ws.send(f"{MARKER} {i}")
+        await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - start
+
+    print(
+        f"{receiver.__name__[len('receive_'):]:6} {rss_per_connection / 1024:8.1f} KiB/connection"
+        f" {clients * messages / elapsed:10.0f} deliveries/s"
+    )
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+
+    for receiver in (receive_ws, receive_sse, receive_poll):
+        with run_server() as (process, port):
+            asyncio.run(run(receiver, port=port, pid=process.pid, clients=args.clients, messages=args.messages))
+
+
+if __name__ == "__main__":
+    main()